@@ -0,0 +1,312 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Benchmark sugar3.datastore.
+
+The representations of the metadata of query results, DSMetadata and the
+read-only records find() returns, are compared on entries built in
+memory.
+
+The client paths are then run against the stand-in data store of
+sugar3.test.datastore on a private bus, with the time they take and the
+number of calls they make on the data store. Usage:
+
+    python datastorebenchmark.py [number of entries]
+
+The default is 10000 entries, the data store gets a tenth of them.
+"""
+
+import gc
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+from sugar3.datastore import datastore
+from sugar3.datastore.datastore import DSMetadata
+from sugar3.datastore.datastore import _MetadataRecord
+from sugar3.test import datastore as datastore_service
+
+DEFAULT_COUNT = 10000
+FILE_SIZE = 16 * 1024 * 1024
+
+
+def _create_entries(count):
+    entries = []
+    for i in range(count):
+        entries.append({
+            'uid': '%08x-0000-0000-0000-000000000000' % i,
+            'title': 'Entry %d' % i,
+            'activity': 'org.laptop.WebActivity',
+            'mtime': '2026-10-18T10:00:%02d' % (i % 60),
+            'timestamp': 1792317600 + i,
+            'icon-color': '#FF2B34,#00A0FF',
+            'keep': '0',
+        })
+    return entries
+
+
+def _get_rss():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def _measure(name, create, entries):
+    gc.collect()
+    rss = _get_rss()
+
+    start = time.time()
+    metadatas = [create(entry) for entry in entries]
+    create_time = time.time() - start
+
+    gc.collect()
+    memory = _get_rss() - rss
+
+    start = time.time()
+    for metadata in metadatas:
+        metadata['title']
+        metadata.get('mime_type')
+    access_time = time.time() - start
+
+    print '%-12s %8.1f ms create %8.1f ms access %8.1f bytes/entry' % (
+        name, create_time * 1000, access_time * 1000,
+        float(memory) / len(entries))
+
+
+class _CountingDataStore(object):
+    """Counts the calls made on the data store"""
+
+    def __init__(self, data_store):
+        self._data_store = data_store
+        self.calls = 0
+
+    def __getattr__(self, name):
+        method = getattr(self._data_store, name)
+        if name == 'connect_to_signal':
+            return method
+
+        def call(*args, **kwargs):
+            self.calls += 1
+            return method(*args, **kwargs)
+        return call
+
+
+def _iterate(duration):
+    context = GLib.MainContext.default()
+    end_time = time.time() + duration
+    while time.time() < end_time:
+        while context.iteration(False):
+            pass
+        time.sleep(0.01)
+
+
+def _run(name, data_store, function, *args):
+    calls = data_store.calls
+    start = time.time()
+    function(*args)
+    elapsed = time.time() - start
+    print '%-40s %8.1f ms %6d calls' % (name, elapsed * 1000,
+                                        data_store.calls - calls)
+
+
+def _fill(entries):
+    object_ids = []
+    for entry in entries:
+        ds_object = datastore.create()
+        ds_object.metadata.update(entry)
+        ds_object.metadata['description'] = 'About ' + entry['title']
+        datastore.write(ds_object)
+        object_ids.append(ds_object.object_id)
+        ds_object.destroy()
+    _iterate(0.5)
+    return object_ids
+
+
+def _forget(object_ids):
+    for object_id in object_ids:
+        datastore._invalidate_metadata(object_id)
+
+
+def benchmark_get(data_store, object_ids):
+    def get_all():
+        for object_id in object_ids:
+            datastore.get(object_id).destroy()
+
+    def get_many():
+        for ds_object in datastore.get_many(object_ids):
+            ds_object.destroy()
+
+    _forget(object_ids)
+    _run('get %d entries' % len(object_ids), data_store, get_all)
+    _run('get %d entries, cached' % len(object_ids), data_store, get_all)
+    _forget(object_ids)
+    _run('get_many %d entries' % len(object_ids), data_store, get_many)
+
+
+def benchmark_find(data_store, count):
+    def find():
+        results, total_count = datastore.find({})
+        for ds_object in results:
+            ds_object.destroy()
+
+    def iter_find(count):
+        for ds_object in datastore.iter_find({}):
+            ds_object.destroy()
+            count -= 1
+            if not count:
+                break
+
+    _run('find all entries', data_store, find)
+    _run('iter_find first entry', data_store, iter_find, 1)
+    _run('iter_find all entries', data_store, iter_find, -1)
+
+    def load_descriptions(prefetch):
+        results, total_count = datastore.find({}, properties=['title'],
+                                              limit=count)
+        if prefetch:
+            for ds_object in results:
+                ds_object.metadata.prefetch(['description'])
+        for ds_object in results:
+            ds_object.metadata['description']
+            ds_object.destroy()
+
+    _run('find %d titles, load descriptions' % count, data_store,
+         load_descriptions, False)
+    _run('find %d titles, prefetch descriptions' % count, data_store,
+         load_descriptions, True)
+
+
+def benchmark_write(data_store, object_id, count, root_path):
+    ds_object = datastore.get(object_id)
+
+    def write(skip_unchanged):
+        for i in range(count):
+            datastore.write(ds_object, skip_unchanged=skip_unchanged)
+
+    _run('write unchanged entry %d times' % count, data_store, write,
+         False)
+    _run('write unchanged entry %d times, skip' % count, data_store, write,
+         True)
+    ds_object.destroy()
+
+    def create(asynchronous):
+        for i in range(count):
+            new_ds_object = datastore.create()
+            new_ds_object.metadata['title'] = 'Created'
+            if asynchronous:
+                datastore.write(new_ds_object,
+                                reply_handler=lambda *args: None,
+                                error_handler=lambda error: None)
+            else:
+                datastore.write(new_ds_object)
+            new_ds_object.destroy()
+
+    _run('create %d entries' % count, data_store, create, False)
+    _run('create %d entries, until write returns' % count, data_store,
+         create, True)
+    _iterate(0.5)
+
+    data = os.urandom(1024 * 1024)
+
+    def write_file(handoff):
+        file_path = os.path.join(root_path, 'file')
+        with open(file_path, 'w') as data_file:
+            for i in range(FILE_SIZE / len(data)):
+                data_file.write(data)
+        new_ds_object = datastore.create()
+        new_ds_object.file_path = file_path
+        datastore.write(new_ds_object, handoff=handoff)
+        new_ds_object.destroy()
+        os.remove(file_path)
+
+    name = 'write a %d MiB file' % (FILE_SIZE / 1024 / 1024)
+    _run(name, data_store, write_file, False)
+    _run(name + ', handoff', data_store, write_file, True)
+
+
+def benchmark_signals(data_store, count):
+    received = []
+
+    def __updated_cb(sender, **kwargs):
+        received.append(kwargs['object_id'])
+
+    datastore.updated.connect(__updated_cb)
+
+    # Entries created and updated by another process, without any DSObject
+    # following their updates
+    object_ids = []
+    for entry in _create_entries(count):
+        del entry['uid']
+        object_ids.append(data_store._data_store.create(
+            dbus.Dictionary(entry), '', False))
+    _iterate(0.5)
+
+    del received[:]
+    for object_id in object_ids:
+        properties = data_store._data_store.get_properties(object_id)
+        properties['keep'] = '1'
+        data_store._data_store.update(object_id, dbus.Dictionary(properties),
+                                      '', False)
+
+    calls = data_store.calls
+    _iterate(1)
+    print '%-40s %8d signals %5d calls' % (
+        '%d entries updated elsewhere' % count, len(received),
+        data_store.calls - calls)
+
+
+def main():
+    count = DEFAULT_COUNT
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    print '%d entries' % count
+    _measure('DSMetadata', DSMetadata, _create_entries(count))
+    _measure('record', _MetadataRecord, _create_entries(count))
+
+    print
+    print 'data store with %d entries' % (count / 10)
+    DBusGMainLoop(set_as_default=True)
+    root_path = tempfile.mkdtemp()
+    bus = datastore_service.start_bus()
+    service = datastore_service.start_service(root_path)
+    try:
+        data_store = _CountingDataStore(datastore._get_data_store())
+        datastore._data_store = data_store
+
+        object_ids = _fill(_create_entries(count / 10))
+        benchmark_get(data_store, object_ids[:50])
+        benchmark_find(data_store, 50)
+        benchmark_write(data_store, object_ids[0], 50, root_path)
+        benchmark_signals(data_store, 50)
+    finally:
+        service.terminate()
+        service.wait()
+        bus.terminate()
+        bus.wait()
+        shutil.rmtree(root_path)
+
+
+if __name__ == '__main__':
+    main()
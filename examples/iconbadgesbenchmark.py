@@ -0,0 +1,71 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Time changing the badge of icons, compositing the cached icon with the
+badge against rendering the badged icon from scratch.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+
+from sugar3.graphics import style
+from sugar3.graphics.icon import _IconBuffer
+
+import common
+
+common.set_theme()
+
+# Start with an empty on-disk icon cache
+sugar_home = tempfile.mkdtemp()
+os.environ['SUGAR_HOME'] = sugar_home
+
+icons = ['network-wireless-000', 'network-wireless-040',
+         'network-wireless-080', 'computer-xo', 'activity-journal']
+badges = ['emblem-favorite', 'emblem-busy', 'emblem-locked']
+
+
+def _create_buffer(icon_name, badge_name):
+    icon = _IconBuffer()
+    icon.icon_name = icon_name
+    icon.width = icon.height = style.STANDARD_ICON_SIZE
+    icon.badge_name = badge_name
+    return icon
+
+
+def _time(render):
+    start = time.time()
+    for icon_name in icons:
+        for badge_name in badges:
+            render(_create_buffer(icon_name, badge_name))
+    count = len(icons) * len(badges)
+    return (time.time() - start) * 1000 / count
+
+
+# Render the icons without badges, as they are shown before a badge is set
+for icon_name in icons:
+    _create_buffer(icon_name, None).get_surface()
+
+rendered = _time(lambda icon: icon._render())
+composited = _time(lambda icon: icon.get_surface())
+
+print 'Rendered badged icons:   %.2f ms per badge change' % rendered
+print 'Composited badged icons: %.2f ms per badge change' % composited
+
+shutil.rmtree(sugar_home)
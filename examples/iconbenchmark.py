@@ -0,0 +1,159 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+"""
+Benchmark the rendering of icons by sugar3.graphics.icon.
+
+The icons are rendered to offscreen cairo surfaces from their files, so
+no display is needed. Usage:
+
+    python iconbenchmark.py [icons directory]
+
+The default directory is the scalable icons of the sugar theme.
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+
+from gi.repository import Rsvg
+
+from sugar3.graphics import icon
+from sugar3.graphics.icon import _IconBuffer
+from sugar3.graphics.icon import _SVGTemplate
+
+DEFAULT_ICONS_PATH = '/usr/share/icons/sugar/scalable'
+SIZES = [55, 110]
+COLORS = [None, ('#FF2B34', '#00A0FF'), ('#AC32FF', '#FF8F00')]
+
+
+def _find_icons(path):
+    icons = []
+    for dir_path, dir_names_, file_names in os.walk(path):
+        for file_name in file_names:
+            if file_name.endswith('.svg'):
+                icons.append(os.path.join(dir_path, file_name))
+    return sorted(icons)
+
+
+def _create_buffer(file_name, size, colors):
+    icon_buffer = _IconBuffer()
+    icon_buffer.file_name = file_name
+    icon_buffer.width = icon_buffer.height = size
+    if colors is not None:
+        icon_buffer.fill_color, icon_buffer.stroke_color = colors
+    return icon_buffer
+
+
+def _report(name, times):
+    times = sorted(times)
+    print '%-28s %8.3f ms mean %8.3f ms median %8.3f ms max' % (
+        name, sum(times) / len(times), times[len(times) / 2], times[-1])
+
+
+def _time(function, *args):
+    start = time.time()
+    function(*args)
+    return (time.time() - start) * 1000
+
+
+def benchmark_svg(icons):
+    parse_times = []
+    regex_times = []
+    template_times = []
+    entities = {'fill_color': '#FF2B34', 'stroke_color': '#00A0FF'}
+
+    for file_name in icons:
+        with open(file_name) as icon_file:
+            data = icon_file.read()
+        parse_times.append(
+            _time(Rsvg.Handle.new_from_data, data.encode('utf-8')))
+
+        def substitute_regex():
+            result = data
+            for entity, value in entities.items():
+                xml = '<!ENTITY %s "%s">' % (entity, value)
+                result = re.sub('<!ENTITY %s .*>' % entity, xml, result)
+        regex_times.append(_time(substitute_regex))
+
+        template = _SVGTemplate(data)
+        template_times.append(_time(template.substitute, entities))
+
+    _report('SVG parse', parse_times)
+    _report('Entities (regex)', regex_times)
+    _report('Entities (template)', template_times)
+
+
+def benchmark_surfaces(icons):
+    specs = [(file_name, size, colors) for file_name in icons
+             for size in SIZES for colors in COLORS]
+
+    cold_times = [_time(_create_buffer(*spec).get_surface) for spec in specs]
+    warm_times = [_time(_create_buffer(*spec).get_surface) for spec in specs]
+    stats = icon.get_cache_stats()['surfaces']
+
+    # Empty the memory cache to read the surfaces from the disk cache
+    icon.set_cache_size(surfaces=0)
+    icon.set_cache_size(surfaces=stats['max_size'])
+    disk_times = [_time(_create_buffer(*spec).get_surface) for spec in specs]
+
+    _report('get_surface() cold', cold_times)
+    _report('get_surface() warm', warm_times)
+    _report('get_surface() disk cache', disk_times)
+
+    lookups = stats['hits'] + stats['misses']
+    print 'Cache hit rate: %.1f%% of %d lookups, %d evictions' % (
+        100.0 * stats['hits'] / lookups, lookups, stats['evictions'])
+    if stats['entries']:
+        print 'Memory per cached surface: %.1f KB (%d surfaces)' % (
+            stats['size'] / 1024.0 / stats['entries'], stats['entries'])
+
+
+def main():
+    if len(sys.argv) > 1:
+        icons_path = sys.argv[1]
+    else:
+        icons_path = DEFAULT_ICONS_PATH
+
+    icons = _find_icons(icons_path)
+    if not icons:
+        print 'No SVG icons found in %s' % icons_path
+        sys.exit(1)
+    print 'Benchmarking %d icons from %s' % (len(icons), icons_path)
+
+    # Start with an empty on-disk icon cache
+    sugar_home = tempfile.mkdtemp()
+    os.environ['SUGAR_HOME'] = sugar_home
+
+    icon.enable_profiling(10)
+    try:
+        benchmark_svg(icons)
+        benchmark_surfaces(icons)
+    finally:
+        shutil.rmtree(sugar_home)
+
+    print 'Slowest icons:'
+    for milliseconds, name, width, height_, sensitive_ in \
+            icon.get_slowest_icons():
+        print '%8.3f ms  %s (%s px)' % (milliseconds, name, width)
+
+
+if __name__ == '__main__':
+    main()
@@ -60,6 +60,7 @@ import json
 
 from gi.repository import Gtk
 from gi.repository import Gdk
+from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gio
 import dbus
@@ -80,6 +81,7 @@ from sugar3.activity.activityservice import ActivityService
 from sugar3.graphics import style
 from sugar3.graphics.window import Window
 from sugar3.graphics.alert import Alert
+from sugar3.graphics.icon import create_atlas
 from sugar3.graphics.icon import Icon
 from sugar3.datastore import datastore
 from sugar3.bundle.activitybundle import get_bundle_instance
@@ -103,6 +105,12 @@ CONN_INTERFACE_ACTIVITY_PROPERTIES = 'org.laptop.Telepathy.ActivityProperties'
 
 PREVIEW_SIZE = style.zoom(300), style.zoom(225)
 
+# Icons of the standard activity toolbars, shared between activities
+_ATLAS_ICONS = [(icon_name, style.STANDARD_ICON_SIZE, None)
+                for icon_name in ['activity-stop', 'edit-undo', 'edit-redo',
+                                  'edit-copy', 'edit-paste', 'zoom-home',
+                                  'zoom-neighborhood', 'edit-description']]
+
 
 class _ActivitySession(GObject.GObject):
 
@@ -658,7 +666,7 @@ class Activity(Window, Gtk.Container):
         notifications.Notify(self.get_id(), 0, '', summary, body, [],
                              {'x-sugar-icon-file-name': icon}, -1)
 
-    def __save_cb(self):
+    def __save_cb(self, object_id=None):
         logging.debug('Activity.__save_cb')
         self._updating_jobject = False
         if self._quit_requested:
@@ -796,16 +804,11 @@ class Activity(Window, Gtk.Container):
                 self._owns_file = True
                 self._jobject.file_path = file_path
 
-        # Cannot call datastore.write async for creates:
-        # https://dev.laptop.org/ticket/3071
-        if self._jobject.object_id is None:
-            datastore.write(self._jobject, transfer_ownership=True)
-        else:
-            self._updating_jobject = True
-            datastore.write(self._jobject,
-                            transfer_ownership=True,
-                            reply_handler=self.__save_cb,
-                            error_handler=self.__save_error_cb)
+        self._updating_jobject = True
+        datastore.write(self._jobject,
+                        transfer_ownership=True,
+                        reply_handler=self.__save_cb,
+                        error_handler=self.__save_error_cb)
 
     def copy(self):
         """Request that the activity 'Keep in Journal' the current state
@@ -1014,6 +1017,10 @@ class Activity(Window, Gtk.Container):
         SugarExt.wm_set_bundle_id(xid, self.get_bundle_id())
         SugarExt.wm_set_activity_id(xid, str(self._activity_id))
 
+        # The first activity populates the shared icon atlas, and rebuilds
+        # it once the icon theme has changed
+        GLib.idle_add(create_atlas, _ATLAS_ICONS)
+
     def __delete_event_cb(self, widget, event):
         self.close()
         return True
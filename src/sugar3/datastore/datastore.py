@@ -24,20 +24,33 @@ import logging
 import time
 from datetime import datetime
 import os
+import fcntl
+from functools import partial
 import tempfile
+import weakref
 from gi.repository import GObject
+from gi.repository import GLib
 from gi.repository import Gio
 import dbus
 
 from sugar3 import env
 from sugar3 import mime
 from sugar3 import dispatch
+from sugar3.util import LRU
 
 DS_DBUS_SERVICE = 'org.laptop.sugar.DataStore'
 DS_DBUS_INTERFACE = 'org.laptop.sugar.DataStore'
 DS_DBUS_PATH = '/org/laptop/sugar/DataStore'
 
 _data_store = None
+_signals_connected = False
+
+# ioctl cloning a file on copy-on-write filesystems, _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+# Metadata of the recently used entries, kept up to date by the signals of
+# the data store
+_metadata_cache = LRU(50)
 
 
 def _get_data_store():
@@ -48,80 +61,287 @@ def _get_data_store():
         _data_store = dbus.Interface(_bus.get_object(DS_DBUS_SERVICE,
                                                      DS_DBUS_PATH),
                                      DS_DBUS_INTERFACE)
-        _data_store.connect_to_signal('Created', __datastore_created_cb)
-        _data_store.connect_to_signal('Deleted', __datastore_deleted_cb)
-        _data_store.connect_to_signal('Updated', __datastore_updated_cb)
 
     return _data_store
 
 
+def _connect_signals():
+    global _signals_connected
+
+    if not _signals_connected:
+        data_store = _get_data_store()
+        data_store.connect_to_signal('Created', __datastore_created_cb)
+        data_store.connect_to_signal('Deleted', __datastore_deleted_cb)
+        data_store.connect_to_signal('Updated', __datastore_updated_cb)
+        _signals_connected = True
+
+
+class _ChangeQueue(object):
+    """Coalesces the changes announced by the data store.
+
+    Entries created or updated within a short delay of each other have
+    their metadata fetched with one asynchronous find() call, and the
+    updated signal is sent once for each of them.
+    """
+
+    _DELAY = 200
+
+    def __init__(self):
+        self._pending = set()
+        self._timeout_id = None
+        # Entries whose metadata is being fetched, by request
+        self._requests = []
+
+    def add(self, object_id):
+        _invalidate_metadata(object_id)
+        self._pending.add(object_id)
+        if self._timeout_id is None:
+            self._timeout_id = GLib.timeout_add(self._DELAY, self.__flush_cb)
+
+    def remove(self, object_id):
+        self._pending.discard(object_id)
+        for object_ids in self._requests:
+            object_ids.discard(object_id)
+
+    def __flush_cb(self):
+        self._timeout_id = None
+
+        object_ids = self._pending
+        self._pending = set()
+        self._requests.append(object_ids)
+
+        logging.debug('datastore: fetching %d changed entries',
+                      len(object_ids))
+        _get_data_store().find(
+            {'uid': list(object_ids)}, [],
+            reply_handler=lambda *args: self.__reply_cb(object_ids, *args),
+            error_handler=lambda error: self.__error_cb(object_ids, error),
+            byte_arrays=True)
+        return False
+
+    def __reply_cb(self, object_ids, entries, total_count):
+        self._requests.remove(object_ids)
+        for metadata in entries:
+            object_id = metadata['uid']
+            # Skip the entries deleted meanwhile
+            if object_id in object_ids:
+                _metadata_cache[object_id] = metadata
+                _unique_values.update(metadata)
+                # Receivers may modify the metadata they get
+                updated.send(None, object_id=object_id,
+                             metadata=dict(metadata))
+
+    def __error_cb(self, object_ids, error):
+        self._requests.remove(object_ids)
+        logging.error('Could not fetch the changed entries: %s', error)
+
+
+_change_queue = _ChangeQueue()
+
+
 def __datastore_created_cb(object_id):
-    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
-    updated.send(None, object_id=object_id, metadata=metadata)
+    _change_queue.add(object_id)
 
 
 def __datastore_updated_cb(object_id):
-    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
-    updated.send(None, object_id=object_id, metadata=metadata)
+    _unique_values.invalidate()
+    _change_queue.add(object_id)
 
 
 def __datastore_deleted_cb(object_id):
+    _change_queue.remove(object_id)
+    _invalidate_metadata(object_id)
+    _unique_values.remove(object_id)
     deleted.send(None, object_id=object_id)
 
-created = dispatch.Signal()
-deleted = dispatch.Signal()
-updated = dispatch.Signal()
 
-_get_data_store()
+def _cache_metadata(object_id, metadata):
+    # The signals keep the cached metadata up to date
+    _connect_signals()
+    _metadata_cache[object_id] = metadata
+
+
+def _get_properties(object_id):
+    if object_id in _metadata_cache:
+        metadata = _metadata_cache[object_id]
+    else:
+        metadata = _get_data_store().get_properties(object_id,
+                                                    byte_arrays=True)
+        _cache_metadata(object_id, metadata)
+    # DSMetadata modifies the dictionary it is given
+    return dict(metadata)
+
+
+def _invalidate_metadata(object_id):
+    if object_id in _metadata_cache:
+        del _metadata_cache[object_id]
+
+
+class _DataStoreSignal(dispatch.Signal):
+    """Signal listening to the data store once a receiver connects"""
+
+    def connect(self, *args, **kwargs):
+        _connect_signals()
+        dispatch.Signal.connect(self, *args, **kwargs)
+
+
+created = _DataStoreSignal()
+deleted = _DataStoreSignal()
+updated = _DataStoreSignal()
+
+
+class _MetadataLoader(object):
+    """Loads the missing properties of partial DSMetadata.
+
+    Properties requested with DSMetadata.prefetch() are kept until some
+    missing property is accessed, then all of them are fetched with a
+    single find() call. The metadata dropped meanwhile is not loaded.
+    """
+
+    def __init__(self):
+        self._pending = weakref.WeakKeyDictionary()
+
+    def request(self, metadata, keys):
+        self._pending.setdefault(metadata, set()).update(keys)
+
+    def load(self, metadata, keys=None):
+        """Load keys, or all of the properties, of metadata now"""
+        if keys is None:
+            metadata._set_loaded(None, _get_properties(metadata._object_id))
+        else:
+            self.request(metadata, keys)
+        self._flush()
+
+    def _flush(self):
+        pending = self._pending
+        self._pending = weakref.WeakKeyDictionary()
+
+        # A loaded property could have been requested since
+        pending = dict((metadata, keys) for metadata, keys in pending.items()
+                       if metadata._object_id is not None)
+        if not pending:
+            return
+
+        keys = set()
+        for metadata_keys in pending.values():
+            keys.update(metadata_keys)
+        keys.add('uid')
+
+        query = {'uid': [metadata._object_id for metadata in pending]}
+        entries, total_count = _get_data_store().find(query, list(keys),
+                                                      byte_arrays=True)
+        entries = dict((entry['uid'], entry) for entry in entries)
+
+        for metadata, metadata_keys in pending.items():
+            properties = entries.get(metadata._object_id, {})
+            metadata._set_loaded(metadata_keys, properties)
+
+
+_metadata_loader = _MetadataLoader()
+
+_DEFAULT_KEYS = ['activity', 'activity_id', 'mime_type', 'title_set_by_user']
 
 
 class DSMetadata(GObject.GObject):
-    """A representation of the metadata associated with a DS entry."""
+    """A representation of the metadata associated with a DS entry.
+
+    If object_id is given, properties only holds some of the metadata of
+    that entry, e.g. the properties requested in a find() call. The other
+    properties are loaded from the data store on first access.
+    """
     __gsignals__ = {
         'updated': (GObject.SignalFlags.RUN_FIRST, None, ([])),
     }
 
-    def __init__(self, properties=None):
+    def __init__(self, properties=None, object_id=None):
         GObject.GObject.__init__(self)
         if not properties:
             self._properties = {}
         else:
             self._properties = properties
 
-        default_keys = ['activity', 'activity_id',
-                        'mime_type', 'title_set_by_user']
-        for key in default_keys:
-            if key not in self._properties:
+        # Only set while some of the properties are not loaded yet
+        self._object_id = object_id
+        self._loaded_keys = set(self._properties)
+
+        if object_id is None:
+            self._set_default_keys(_DEFAULT_KEYS)
+
+        self._dirty_keys = set()
+
+    def _set_default_keys(self, keys):
+        for key in keys:
+            if key in _DEFAULT_KEYS and key not in self._properties:
                 self._properties[key] = ''
 
+    def _load(self, keys=None):
+        if self._object_id is None:
+            return
+        if keys is not None:
+            keys = [key for key in keys if key not in self._loaded_keys]
+            if not keys:
+                return
+        _metadata_loader.load(self, keys)
+
+    def _set_loaded(self, keys, properties):
+        # keys are the properties that were requested, None for all of them
+        for key, value in properties.items():
+            if key not in self._loaded_keys:
+                self._properties[key] = value
+
+        if keys is None:
+            self._set_default_keys(_DEFAULT_KEYS)
+            self._object_id = None
+        else:
+            self._set_default_keys(keys)
+            self._loaded_keys.update(keys)
+
+    def prefetch(self, keys):
+        """Load the given properties together with the next property that
+        is loaded from the data store, in the same request.
+        """
+        keys = [key for key in keys if key not in self._loaded_keys]
+        if self._object_id is not None and keys:
+            _metadata_loader.request(self, keys)
+
     def __getitem__(self, key):
+        self._load([key])
         return self._properties[key]
 
     def __setitem__(self, key, value):
+        self._loaded_keys.add(key)
         if key not in self._properties or self._properties[key] != value:
             self._properties[key] = value
+            self._dirty_keys.add(key)
             self.emit('updated')
 
     def __delitem__(self, key):
+        self._load([key])
         del self._properties[key]
+        self._dirty_keys.add(key)
 
     def __contains__(self, key):
+        self._load([key])
         return self._properties.__contains__(key)
 
     def has_key(self, key):
         logging.warning(".has_key() is deprecated, use 'in'")
-        return key in self._properties
+        return key in self
 
     def keys(self):
+        self._load()
         return self._properties.keys()
 
     def get_dictionary(self):
+        self._load()
         return self._properties
 
     def copy(self):
+        self._load()
         return DSMetadata(self._properties.copy())
 
     def get(self, key, default=None):
+        self._load([key])
         if key in self._properties:
             return self._properties[key]
         else:
@@ -132,6 +352,87 @@ class DSMetadata(GObject.GObject):
         for (key, value) in properties.items():
             self[key] = value
 
+    def get_dirty_keys(self):
+        """Return the keys changed or deleted since the last write"""
+        return set(self._dirty_keys)
+
+    def clear_dirty(self, keys=None):
+        """Mark the given keys, or all of the metadata, as written"""
+        if keys is None:
+            self._dirty_keys.clear()
+        else:
+            self._dirty_keys.difference_update(keys)
+
+
+class _MetadataRecord(object):
+    """Read-only metadata of a DS entry returned by a query.
+
+    It is much cheaper to create than a DSMetadata, which is only created
+    when the metadata is modified or any other DSMetadata method is used.
+    From then on, the record forwards everything to the DSMetadata.
+
+    If object_id is given, properties only holds some of the metadata, as
+    with DSMetadata.
+    """
+
+    __slots__ = ('_properties', '_object_id', '_metadata')
+
+    def __init__(self, properties, object_id=None):
+        self._properties = properties
+        self._object_id = object_id
+        self._metadata = None
+
+    def _get_metadata(self):
+        if self._metadata is None:
+            self._metadata = DSMetadata(self._properties, self._object_id)
+            self._properties = None
+        return self._metadata
+
+    def __getattr__(self, name):
+        return getattr(self._get_metadata(), name)
+
+    def __getitem__(self, key):
+        if self._metadata is None:
+            if key in self._properties:
+                return self._properties[key]
+            elif self._object_id is None and key in _DEFAULT_KEYS:
+                return ''
+        return self._get_metadata()[key]
+
+    def __setitem__(self, key, value):
+        self._get_metadata()[key] = value
+
+    def __delitem__(self, key):
+        del self._get_metadata()[key]
+
+    def __contains__(self, key):
+        if self._metadata is None:
+            if key in self._properties or key in _DEFAULT_KEYS:
+                return True
+            elif self._object_id is None:
+                return False
+        return key in self._get_metadata()
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        if self._metadata is None and self._object_id is None:
+            return list(set(self._properties.keys() + _DEFAULT_KEYS))
+        return self._get_metadata().keys()
+
+    def copy(self):
+        if self._metadata is None and self._object_id is None:
+            return DSMetadata(dict(self._properties))
+        return self._get_metadata().copy()
+
+    def get_dirty_keys(self):
+        if self._metadata is None:
+            return set()
+        return self._metadata.get_dirty_keys()
+
 
 class DSObject(object):
     """A representation of a DS entry."""
@@ -139,6 +440,7 @@ class DSObject(object):
     def __init__(self, object_id, metadata=None, file_path=None):
         self._update_signal_match = None
         self._object_id = None
+        self._pending_writes = None
 
         self.set_object_id(object_id)
 
@@ -151,6 +453,10 @@ class DSObject(object):
         return self._object_id
 
     def set_object_id(self, object_id):
+        # Setting the id explicitly detaches the entry from any create
+        # still in flight, its uid will not be assigned to us
+        self._pending_writes = None
+
         if self._update_signal_match is not None:
             self._update_signal_match.remove()
         if object_id is not None:
@@ -164,11 +470,13 @@ class DSObject(object):
     def __object_updated_cb(self, object_id):
         properties = _get_data_store().get_properties(self._object_id,
                                                       byte_arrays=True)
+        _cache_metadata(self._object_id, properties)
         self._metadata.update(properties)
+        self._metadata.clear_dirty(properties.keys())
 
     def get_metadata(self):
         if self._metadata is None and self.object_id is not None:
-            properties = _get_data_store().get_properties(self.object_id)
+            properties = _get_properties(self.object_id)
             metadata = DSMetadata(properties)
             self._metadata = metadata
         return self._metadata
@@ -195,6 +503,31 @@ class DSObject(object):
 
     file_path = property(get_file_path, set_file_path)
 
+    def open_file(self):
+        """Open the file of the entry for reading.
+
+        The file is read from the data store in place, unlike file_path
+        no file is kept around for this object.
+
+        Return: a file object, None if the entry has no file
+
+        """
+        if self._file_path is not None or self.object_id is None:
+            file_path = self._file_path
+            remove = False
+        else:
+            file_path = _get_data_store().get_filename(self.object_id)
+            remove = True
+
+        if not file_path:
+            return None
+
+        data_file = open(file_path, 'rb')
+        if remove:
+            # The opened file remains readable
+            os.remove(file_path)
+        return data_file
+
     def destroy(self):
         if self._destroyed:
             logging.warning('This DSObject has already been destroyed!.')
@@ -292,13 +625,82 @@ def get(object_id):
     if object_id.startswith('/'):
         return RawObject(object_id)
 
-    metadata = _get_data_store().get_properties(object_id, byte_arrays=True)
+    metadata = _get_properties(object_id)
 
     ds_object = DSObject(object_id, DSMetadata(metadata), None)
     # TODO: register the object for updates
     return ds_object
 
 
+def get_many(object_ids, properties=None, reply_handler=None,
+             error_handler=None):
+    """Get the properties of several objects with a single request.
+
+    Entries whose metadata is cached are not requested again, the other
+    ones are fetched with one find() call on their uids.
+
+    Keyword arguments:
+    object_ids -- list of unique identifiers of the objects
+    properties -- list of the metadata to get, e.g. ['title', 'keep'],
+                  default None to get all of it
+    reply_handler -- will be called with the list of DSObjects as argument
+                     (default None)
+    error_handler -- will be called with an instance of a DBusException
+                     representing a remote exception (default None)
+
+    Return: list of DSObjects, in the order of object_ids, with None for
+    the objects that were not found; nothing if the handlers are given
+
+    """
+    logging.debug('datastore.get_many')
+
+    found = {}
+    missing = []
+    for object_id in object_ids:
+        if object_id.startswith('/'):
+            found[object_id] = RawObject(object_id)
+        elif properties is None and object_id in _metadata_cache:
+            found[object_id] = DSObject(
+                object_id, DSMetadata(_get_properties(object_id)), None)
+        else:
+            missing.append(object_id)
+
+    def __find_reply_cb(entries, total_count):
+        for entry in entries:
+            if not properties:
+                _cache_metadata(entry['uid'], entry)
+                metadata = _MetadataRecord(dict(entry))
+            else:
+                metadata = _MetadataRecord(entry, entry['uid'])
+            found[entry['uid']] = DSObject(entry['uid'], metadata, None)
+        return [found.get(object_id) for object_id in object_ids]
+
+    if not missing:
+        ds_objects = [found[object_id] for object_id in object_ids]
+        if reply_handler and error_handler:
+            reply_handler(ds_objects)
+            return
+        return ds_objects
+
+    query = {'uid': missing}
+    if properties is None:
+        properties = []
+    elif 'uid' not in properties:
+        properties = properties + ['uid']
+
+    if reply_handler and error_handler:
+        _get_data_store().find(
+            query, properties,
+            reply_handler=lambda *args: reply_handler(__find_reply_cb(*args)),
+            error_handler=error_handler,
+            byte_arrays=True)
+        return
+
+    entries, total_count = _get_data_store().find(query, properties,
+                                                  byte_arrays=True)
+    return __find_reply_cb(entries, total_count)
+
+
 def create():
     """Create a new DSObject.
 
@@ -335,8 +737,40 @@ def _create_ds_entry(properties, filename, transfer_ownership=False):
     return object_id
 
 
+def _clone_file(file_path):
+    """Make a clone of the file in its directory without copying its
+    data: a reflink where the filesystem supports it, else a hard link.
+
+    Return: path of the clone, None if the file can not be cloned
+
+    """
+    try:
+        fd, clone_path = tempfile.mkstemp(dir=os.path.dirname(file_path),
+                                          prefix='.handoff')
+    except OSError:
+        return None
+
+    try:
+        with open(file_path, 'rb') as source:
+            fcntl.ioctl(fd, _FICLONE, source.fileno())
+        return clone_path
+    except (IOError, OSError):
+        logging.debug('datastore: cannot reflink %s', file_path)
+    finally:
+        os.close(fd)
+
+    os.remove(clone_path)
+    try:
+        os.link(file_path, clone_path)
+    except OSError:
+        logging.debug('datastore: cannot hard link %s', file_path)
+        return None
+    return clone_path
+
+
 def write(ds_object, update_mtime=True, transfer_ownership=False,
-          reply_handler=None, error_handler=None, timeout=-1):
+          reply_handler=None, error_handler=None, timeout=-1,
+          skip_unchanged=False, handoff=False):
     """Write the DSObject given to the datastore. Creates a new entry if
     the entry does not exist yet.
 
@@ -347,27 +781,103 @@ def write(ds_object, update_mtime=True, transfer_ownership=False,
                           be passed - who is responsible to delete the file
                           when done with it (default False)
     reply_handler -- will be called with the method's return values as
-                     arguments (default None)
+                     arguments, for a new entry this is its object id
+                     (default None)
     error_handler -- will be called with an instance of a DBusException
                      representing a remote exception (default None)
     timeout -- dbus timeout for the caller to wait (default -1)
+    skip_unchanged -- do not write an existing entry if no metadata has
+                      changed since it was last written and there is no
+                      new file (default False)
+    handoff -- set it to true to hand the data store a reflink or hard link
+               of the file instead of having it copy the file, the file
+               must then not be modified in place; it is copied if it can
+               not be linked (default False)
+
+    When both handlers are given the write does not block, also for new
+    entries. The object id is set once the entry has been created, later
+    writes of the same object are sent after the create has completed.
 
     """
     logging.debug('datastore.write')
 
+    file_path = ds_object.get_file_path(fetch=False)
+    if file_path is None:
+        file_path = ''
+
+    if skip_unchanged and ds_object.object_id and not file_path and \
+            not ds_object.metadata.get_dirty_keys():
+        logging.debug('datastore.write: %s is unchanged', ds_object.object_id)
+        if reply_handler is not None:
+            reply_handler()
+        return
+
+    # The data store replaces all of the metadata of an entry on update,
+    # so the unchanged properties have to be sent as well
     properties = ds_object.metadata.get_dictionary().copy()
+    dirty_keys = ds_object.metadata.get_dirty_keys()
+    written = properties.copy()
 
     if update_mtime:
         properties['mtime'] = datetime.now().isoformat()
         properties['timestamp'] = int(time.time())
 
-    file_path = ds_object.get_file_path(fetch=False)
-    if file_path is None:
-        file_path = ''
+    clone_path = None
+    if handoff and file_path and not transfer_ownership:
+        # The data store moves files it owns into place, so owning a
+        # clone avoids any copy on the same filesystem
+        clone_path = _clone_file(file_path)
+        if clone_path is not None:
+            file_path = clone_path
+            transfer_ownership = True
+
+    def __written():
+        # Keys changed again meanwhile still have to be written
+        metadata = ds_object.metadata
+        metadata.clear_dirty([key for key in dirty_keys
+                              if metadata.get(key) == written.get(key)])
+
+    asynchronous = bool(reply_handler and error_handler)
+    if asynchronous:
+        def __reply_cb(callback, *args):
+            __written()
+            callback(*args)
+        reply_handler = partial(__reply_cb, reply_handler)
+
+    if clone_path is not None and error_handler is not None:
+        def __error_cb(callback, error):
+            if os.path.exists(clone_path):
+                os.remove(clone_path)
+            callback(error)
+        error_handler = partial(__error_cb, error_handler)
+
+    try:
+        _write_entry(ds_object, properties, file_path, transfer_ownership,
+                     reply_handler, error_handler, timeout)
+    except Exception:
+        if clone_path is not None and os.path.exists(clone_path):
+            os.remove(clone_path)
+        raise
+
+    if not asynchronous:
+        __written()
+
+
+def _write_entry(ds_object, properties, file_path, transfer_ownership,
+                 reply_handler, error_handler, timeout):
+    if ds_object._pending_writes is not None:
+        # Writes must reach the data store after the create they follow
+        if reply_handler and error_handler:
+            ds_object._pending_writes.append(
+                (properties, file_path, transfer_ownership, reply_handler,
+                 error_handler, timeout))
+            return
+        context = GLib.MainContext.default()
+        while ds_object._pending_writes is not None:
+            context.iteration(True)
 
-    # FIXME: this func will be sync for creates regardless of the handlers
-    # supplied. This is very bad API, need to decide what to do here.
     if ds_object.object_id:
+        _invalidate_metadata(ds_object.object_id)
         _update_ds_entry(ds_object.object_id,
                          properties,
                          file_path,
@@ -375,14 +885,48 @@ def write(ds_object, update_mtime=True, transfer_ownership=False,
                          reply_handler=reply_handler,
                          error_handler=error_handler,
                          timeout=timeout)
+    elif reply_handler and error_handler and \
+            dbus.get_default_main_loop() is not None:
+        pending_writes = []
+        ds_object._pending_writes = pending_writes
+
+        def reply_cb(object_id):
+            if ds_object._pending_writes is pending_writes:
+                ds_object.object_id = object_id
+                ds_object.metadata['uid'] = object_id
+                ds_object.metadata.clear_dirty(['uid'])
+            logging.debug('Written object %s to the datastore.', object_id)
+            # The queued writes are older than the writes of the handler
+            try:
+                for write_args in pending_writes:
+                    _update_ds_entry(object_id, *write_args)
+            finally:
+                reply_handler(object_id)
+
+        def error_cb(error):
+            if ds_object._pending_writes is pending_writes:
+                ds_object._pending_writes = None
+            try:
+                # The entry does not exist, the next queued write creates it
+                for write_args in pending_writes:
+                    _write_entry(ds_object, *write_args)
+            finally:
+                error_handler(error)
+
+        _get_data_store().create(dbus.Dictionary(properties), file_path,
+                                 transfer_ownership,
+                                 reply_handler=reply_cb,
+                                 error_handler=error_cb,
+                                 timeout=timeout)
+        return
     else:
-        if reply_handler or error_handler:
-            logging.warning('datastore.write() cannot currently be called'
-                            'async for creates, see ticket 3071')
         ds_object.object_id = _create_ds_entry(properties, file_path,
                                                transfer_ownership)
         ds_object.metadata['uid'] = ds_object.object_id
-        # TODO: register the object for updates
+        ds_object.metadata.clear_dirty(['uid'])
+        if reply_handler is not None:
+            # Replies can not be dispatched, the create was synchronous
+            reply_handler(ds_object.object_id)
     logging.debug('Written object %s to the datastore.', ds_object.object_id)
 
 
@@ -394,6 +938,7 @@ def delete(object_id):
 
     """
     logging.debug('datastore.delete')
+    _invalidate_metadata(object_id)
     _get_data_store().delete(object_id)
 
 
@@ -424,7 +969,8 @@ def find(query, sorting=None, limit=None, offset=None, properties=None,
     limit -- return only limit results (default None)
     offset -- return only results starting at offset (default None)
     properties -- you can specify here a list of metadata you want to be
-                  present in the result e.g. ['title, 'keep'] (default None)
+                  present in the result e.g. ['title, 'keep'], the other
+                  metadata is loaded when first accessed (default None)
     reply_handler -- will be called with the method's return values as
                      arguments (default None)
     error_handler -- will be called with an instance of a DBusException
@@ -437,6 +983,8 @@ def find(query, sorting=None, limit=None, offset=None, properties=None,
 
     if properties is None:
         properties = []
+    elif 'uid' not in properties:
+        properties = properties + ['uid']
 
     if sorting:
         query['order_by'] = sorting
@@ -454,26 +1002,115 @@ def find(query, sorting=None, limit=None, offset=None, properties=None,
     else:
         entries, total_count = _get_data_store().find(query, properties,
                                                       byte_arrays=True)
+
+    return _create_ds_objects(entries, bool(properties)), total_count
+
+
+def _create_ds_objects(entries, partial=False):
     ds_objects = []
     for entry in entries:
         object_id = entry['uid']
         del entry['uid']
 
-        ds_object = DSObject(object_id, DSMetadata(entry), None)
+        if partial:
+            metadata = _MetadataRecord(entry, object_id)
+        else:
+            metadata = _MetadataRecord(entry)
+        ds_object = DSObject(object_id, metadata, None)
         ds_objects.append(ds_object)
+    return ds_objects
 
-    return ds_objects, total_count
 
+class _FindRequest(object):
+    """A find() call on the data store whose reply can be waited for."""
 
-def copy(ds_object, mount_point):
-    """Copy a datastore entry
+    def __init__(self, query, properties):
+        self._reply = None
+        self._error = None
+
+        if dbus.get_default_main_loop() is None:
+            # Replies can not be dispatched, call synchronously
+            self._reply = _get_data_store().find(query, properties,
+                                                 byte_arrays=True)
+            return
+
+        _get_data_store().find(query, properties,
+                               reply_handler=self.__reply_cb,
+                               error_handler=self.__error_cb,
+                               byte_arrays=True)
+
+    def __reply_cb(self, entries, total_count):
+        self._reply = (entries, total_count)
+
+    def __error_cb(self, error):
+        self._error = error
+
+    def wait(self):
+        context = GLib.MainContext.default()
+        while self._reply is None and self._error is None:
+            context.iteration(True)
+
+        if self._error is not None:
+            raise self._error
+        return self._reply
+
+
+def iter_find(query, sorting=None, properties=None, page_size=100):
+    """Iterate over the DS entries that match the query, page by page.
+
+    Unlike find(), the results are not all loaded at once: they are
+    requested page_size entries at a time, and the next page is requested
+    while the current one is being consumed. Stop iterating, or call close()
+    on the iterator, to cancel the remaining requests.
+
+    If a page has not arrived yet when it is needed, the default main
+    context is iterated until it does, so other sources can be dispatched
+    meanwhile.
 
     Keyword arguments:
-    ds_object -- DSObject to copy
-    mount_point -- mount point of the new datastore entry
+    query -- a dictionary containing metadata key value pairs, see find()
+    sorting -- key to order results by e.g. 'timestamp' (default None)
+    properties -- you can specify here a list of metadata you want to be
+                  present in the result e.g. ['title, 'keep'] (default None)
+    page_size -- number of entries requested at a time (default 100)
+
+    Return: iterator over the DSObjects matching the query
 
     """
-    new_ds_object = ds_object.copy()
+    query = query.copy()
+
+    if properties is None:
+        properties = []
+    elif 'uid' not in properties:
+        properties = properties + ['uid']
+
+    if sorting:
+        query['order_by'] = sorting
+    query['limit'] = page_size
+
+    offset = query.get('offset', 0)
+    query['offset'] = offset
+    request = _FindRequest(query.copy(), properties)
+
+    while request is not None:
+        entries, total_count = request.wait()
+
+        offset += len(entries)
+        if entries and offset < total_count:
+            query['offset'] = offset
+            request = _FindRequest(query.copy(), properties)
+        else:
+            request = None
+
+        for ds_object in _create_ds_objects(entries, bool(properties)):
+            yield ds_object
+
+
+def _prepare_copy(ds_object, mount_point):
+    # Also works for a RawObject, which can not be copied itself
+    new_ds_object = DSObject(None, ds_object.metadata.copy(), None)
+    if 'uid' in new_ds_object.metadata:
+        del new_ds_object.metadata['uid']
     new_ds_object.metadata['mountpoint'] = mount_point
 
     if 'title' in ds_object.metadata:
@@ -487,20 +1124,278 @@ def copy(ds_object, mount_point):
 
         new_ds_object.metadata['suggested_filename'] = filename
 
+    return new_ds_object
+
+
+def copy(ds_object, mount_point):
+    """Copy a datastore entry
+
+    Keyword arguments:
+    ds_object -- DSObject to copy
+    mount_point -- mount point of the new datastore entry
+
+    """
+    new_ds_object = _prepare_copy(ds_object, mount_point)
+
     # this will cause the file be retrieved from the DS
     new_ds_object.file_path = ds_object.file_path
 
     write(new_ds_object)
 
 
+class _CopyRequest(object):
+    """Copies DS entries to a mount point, a few at a time.
+
+    The file of an entry is retrieved while others are being written, and
+    the retrieved file is handed over to the data store.
+    """
+
+    def __init__(self, ds_objects, mount_point, max_pending, progress_cb,
+                 reply_handler):
+        self._queue = list(ds_objects)
+        self._mount_point = mount_point
+        self._max_pending = max_pending
+        self._progress_cb = progress_cb
+        self._reply_handler = reply_handler
+
+        self._total = len(self._queue)
+        self._pending = 0
+        self._done = 0
+        self._size = 0
+        self._start_time = time.time()
+        self._start_id = None
+        self.failed = []
+        self.finished = False
+
+        if self._queue:
+            self._start_next()
+        else:
+            GLib.idle_add(self._finish)
+
+    def _start_next(self):
+        while self._queue and self._pending < self._max_pending:
+            ds_object = self._queue.pop(0)
+            self._pending += 1
+            self._fetch(ds_object)
+
+    def __start_next_cb(self):
+        self._start_id = None
+        self._start_next()
+        return False
+
+    def _fetch(self, ds_object):
+        if isinstance(ds_object, RawObject):
+            # The object id is the path of the file
+            self._write(ds_object, ds_object.object_id, False)
+            return
+
+        try:
+            file_path = ds_object.get_file_path(fetch=False)
+            if file_path is None and ds_object.object_id is not None:
+                _get_data_store().get_filename(
+                    ds_object.object_id,
+                    reply_handler=lambda path: self._write(ds_object, path,
+                                                           True),
+                    error_handler=lambda error: self._failed(ds_object,
+                                                             error))
+                return
+        except Exception, e:
+            logging.exception('Error copying %s', ds_object.object_id)
+            self._failed(ds_object, e)
+            return
+
+        self._write(ds_object, file_path, False)
+
+    def _write(self, ds_object, file_path, owns_file):
+        def reply_cb(*args):
+            new_ds_object.destroy()
+            self._size += size
+            self._copied()
+
+        def error_cb(error):
+            new_ds_object.destroy()
+            if owns_file and os.path.exists(file_path):
+                os.remove(file_path)
+            self._failed(ds_object, error)
+
+        try:
+            new_ds_object = _prepare_copy(ds_object, self._mount_point)
+            size = 0
+            if file_path:
+                size = os.path.getsize(file_path)
+                new_ds_object.file_path = file_path
+
+            write(new_ds_object, transfer_ownership=owns_file,
+                  reply_handler=reply_cb, error_handler=error_cb)
+        except Exception, e:
+            logging.exception('Error copying %s', ds_object.object_id)
+            self._failed(ds_object, e)
+
+    def _failed(self, ds_object, error):
+        logging.error('Could not copy %s: %s', ds_object.object_id, error)
+        self.failed.append((ds_object, error))
+        self._copied()
+
+    def _copied(self):
+        self._pending -= 1
+        self._done += 1
+
+        if self._progress_cb is not None:
+            elapsed = max(time.time() - self._start_time, 1e-6)
+            self._progress_cb(self._done, self._total, self._size / elapsed)
+
+        if self._done == self._total:
+            self._finish()
+        elif self._start_id is None:
+            # Entries failing right away would otherwise recurse
+            self._start_id = GLib.idle_add(self.__start_next_cb)
+
+    def _finish(self):
+        self.finished = True
+        if self._reply_handler is not None:
+            self._reply_handler(self.failed)
+        return False
+
+
+def copy_many(ds_objects, mount_point, progress_cb=None, reply_handler=None,
+              max_pending=4):
+    """Copy several datastore entries
+
+    Up to max_pending entries are copied at the same time, an entry that
+    can not be copied does not stop the others from being copied.
+
+    Keyword arguments:
+    ds_objects -- list of DSObjects to copy
+    mount_point -- mount point of the new datastore entries
+    progress_cb -- will be called each time an entry has been processed
+                   with the number of processed entries, the number of
+                   entries and the throughput in bytes per second
+                   (default None)
+    reply_handler -- will be called when all of the entries have been
+                     processed with the list of (ds_object, error) of the
+                     entries that could not be copied (default None)
+    max_pending -- maximum number of entries being copied at the same time
+                   (default 4)
+
+    Return: the list of (ds_object, error) of the entries that could not
+    be copied; nothing if reply_handler is given
+
+    """
+    logging.debug('datastore.copy_many')
+
+    request = _CopyRequest(ds_objects, mount_point, max_pending, progress_cb,
+                           reply_handler)
+    if reply_handler is not None:
+        return
+
+    context = GLib.MainContext.default()
+    while not request.finished:
+        context.iteration(True)
+    return request.failed
+
+
+class _UniqueValues(object):
+    """The values of metadata keys across all of the DS entries.
+
+    The values of a key are looked up once with get_uniquevaluesfor(),
+    then the values of the created entries are added to them. An updated
+    or deleted entry may have had the last use of a value, the keys are
+    then looked up again on next use.
+
+    The data store only looks up some keys, e.g. 'activity'. The values
+    of the other keys are collected from the entries, and the values of
+    each entry are kept to follow its updates and deletion.
+    """
+
+    def __init__(self):
+        # Values looked up by the data store, by key
+        self._values = {}
+        # Values of each entry, by key, for the collected keys
+        self._entry_values = {}
+        # Number of entries with each value, by key, for the collected keys
+        self._counts = {}
+
+    def _split(self, key, value):
+        if not value:
+            return []
+        elif key == 'tags':
+            return value.replace(',', ' ').split()
+        return [value]
+
+    def _set(self, key, object_id, value):
+        entry_values = self._entry_values[key]
+        counts = self._counts[key]
+
+        for old_value in entry_values.pop(object_id, []):
+            counts[old_value] -= 1
+            if not counts[old_value]:
+                del counts[old_value]
+
+        values = set(self._split(key, value))
+        if values:
+            entry_values[object_id] = values
+            for new_value in values:
+                counts[new_value] = counts.get(new_value, 0) + 1
+
+    def _look_up(self, key):
+        try:
+            values = _get_data_store().get_uniquevaluesfor(
+                key, dbus.Dictionary({}, signature='ss'))
+        except dbus.DBusException:
+            logging.debug('datastore: collecting the values of %s', key)
+            entries, total_count = _get_data_store().find(
+                {}, [key, 'uid'], byte_arrays=True)
+            self._entry_values[key] = {}
+            self._counts[key] = {}
+            for entry in entries:
+                self._set(key, entry['uid'], entry.get(key))
+            return
+
+        self._values[key] = set()
+        for value in values:
+            self._values[key].update(self._split(key, value))
+
+    def get(self, key):
+        if key not in self._values and key not in self._counts:
+            # The signals keep the values up to date
+            _connect_signals()
+            self._look_up(key)
+
+        if key in self._counts:
+            return sorted(self._counts[key])
+        return sorted(self._values[key])
+
+    def update(self, metadata):
+        object_id = metadata['uid']
+        for key in self._counts:
+            self._set(key, object_id, metadata.get(key))
+        for key, values in self._values.items():
+            values.update(self._split(key, metadata.get(key)))
+
+    def invalidate(self):
+        # It is not known which entries have the looked up values
+        self._values.clear()
+
+    def remove(self, object_id):
+        for key in self._counts:
+            self._set(key, object_id, None)
+        self.invalidate()
+
+
+_unique_values = _UniqueValues()
+
+
 def get_unique_values(key):
     """Retrieve an array of unique values for a field.
 
+    The values are cached and updated as entries are created, updated
+    and deleted.
+
     Keyword arguments:
-    key -- only the property activity is currently supported
+    key -- the property, e.g. 'activity', 'mime_type' or 'tags'; the tags
+           of an entry are split into separate values
 
-    Return: list of activities
+    Return: list of values
 
     """
-    return _get_data_store().get_uniquevaluesfor(
-        key, dbus.Dictionary({}, signature='ss'))
+    return _unique_values.get(key)
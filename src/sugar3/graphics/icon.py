@@ -21,49 +21,555 @@ A small fixed size picture, typically used to decorate components.
 STABLE.
 """
 
+import os
 import re
+import heapq
+import atexit
+import bisect
+import json
 import math
+import mmap
+import time
+import Queue
+import struct
+import hashlib
 import logging
+import tempfile
+import threading
+import weakref
 
 from gi.repository import GObject
+from gi.repository import GLib
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GdkPixbuf
 from gi.repository import Rsvg
 import cairo
 
+from sugar3 import env
 from sugar3.graphics import style
 from sugar3.graphics.xocolor import XoColor
 from sugar3.util import LRU
+from sugar3.util import SizedLRU
 
 _BADGE_SIZE = 0.45
+# Opacity of insensitive icons, like the GTK+ default rendering
+_INSENSITIVE_ALPHA = 0.3
+
+
+def _get_cache_size(name, default):
+    # Cache sizes can be tuned per device, in kilobytes
+    try:
+        return int(os.environ.get(name, default)) * 1024
+    except ValueError:
+        logging.error('Invalid value for %s, using the default', name)
+        return default * 1024
+
+
+def _get_surface_size(surface):
+    return surface.get_stride() * surface.get_height()
+
+
+def _get_cached_size(value):
+    # The packed icons of cell renderers share the surface cache budget
+    if isinstance(value, _PackedIcon):
+        if value.surface is None:
+            return 0
+        value = value.surface
+    return _get_surface_size(value)
+
+
+# Surfaces can only be rendered at the device scale with cairo >= 1.14
+_HAS_DEVICE_SCALE = hasattr(cairo.ImageSurface, 'set_device_scale')
+
+
+def _get_surface_logical_size(surface):
+    width = surface.get_width()
+    height = surface.get_height()
+    if _HAS_DEVICE_SCALE:
+        x_scale, y_scale = surface.get_device_scale()
+        width = int(round(width / x_scale))
+        height = int(round(height / y_scale))
+    return width, height
+
+
+class _SVGTemplate(object):
+    """An SVG document with the position of its entity declarations located.
+
+    The document is split once at every <!ENTITY name ...> declaration so
+    that colorizing it is a matter of joining the chunks with the new
+    declarations, instead of searching the whole text for each entity.
+    """
+
+    _ENTITY_RE = re.compile(r'<!ENTITY\s+(\w+)\s[^>]*>')
+
+    def __init__(self, data):
+        self.size = len(data)
+        self._chunks = []
+        self._slots = {}
+
+        position = 0
+        for match in self._ENTITY_RE.finditer(data):
+            self._chunks.append(data[position:match.start()])
+            self._slots.setdefault(match.group(1), []).append(
+                len(self._chunks))
+            self._chunks.append(match.group(0))
+            position = match.end()
+        self._chunks.append(data[position:])
+
+    def substitute(self, entities):
+        chunks = list(self._chunks)
+        for entity, value in entities.items():
+            for index in self._slots.get(entity, []):
+                chunks[index] = '<!ENTITY %s "%s">' % (entity, value)
+        return ''.join(chunks)
 
 
 class _SVGLoader(object):
 
     def __init__(self):
-        self._cache = LRU(50)
+        self._cache = SizedLRU(
+            _get_cache_size('SUGAR_ICON_SVG_CACHE_SIZE', 1024),
+            lambda template: template.size)
+        self._handle_cache = LRU(50)
 
-    def load(self, file_name, entities, cache):
+    def get_cache_stats(self):
+        return self._cache.get_stats()
+
+    def set_cache_size(self, size):
+        self._cache.set_max_size(size)
+
+    def _get_template(self, file_name, cache):
         if file_name in self._cache:
-            icon = self._cache[file_name]
-        else:
-            icon_file = open(file_name, 'r')
-            icon = icon_file.read()
-            icon_file.close()
+            return self._cache[file_name]
+
+        icon_file = open(file_name, 'r')
+        template = _SVGTemplate(icon_file.read())
+        icon_file.close()
 
-            if cache:
-                self._cache[file_name] = icon
+        if cache:
+            self._cache[file_name] = template
+        return template
 
+    def load(self, file_name, entities, cache):
+        valid_entities = {}
         for entity, value in entities.items():
             if isinstance(value, basestring):
-                xml = '<!ENTITY %s "%s">' % (entity, value)
-                icon = re.sub('<!ENTITY %s .*>' % entity, xml, icon)
+                valid_entities[entity] = value
             else:
                 logging.error(
                     'Icon %s, entity %s is invalid.', file_name, entity)
 
-        return Rsvg.Handle.new_from_data(icon.encode('utf-8'))
+        handle_key = (file_name, tuple(sorted(valid_entities.items())))
+        if handle_key in self._handle_cache:
+            return self._handle_cache[handle_key]
+
+        icon = self._get_template(file_name, cache).substitute(valid_entities)
+        handle = Rsvg.Handle.new_from_data(icon.encode('utf-8'))
+
+        if cache:
+            self._handle_cache[handle_key] = handle
+        return handle
+
+
+class _SurfaceDiskCache(object):
+    """Persistent cache of rendered image surfaces.
+
+    Each entry is a file holding the raw pixel data followed by a small
+    trailer describing the surface and the icon it was rendered from.
+    Entries are loaded by memory-mapping the pixels, so the pages are
+    shared with the page cache and only copied if the surface is drawn on.
+
+    Entries are written by a thread of their own, so that rendering does
+    not wait for the disk. The least recently used entries are pruned,
+    using the modification time refreshed when they are loaded. The cache
+    is used from the rendering threads too, its state is only set up
+    under the lock and otherwise only changed by the writer thread.
+    """
+
+    _TRAILER = struct.Struct('<4siiiiii')
+    _MAGIC = 'SIC2'
+    _MAX_ENTRIES = 2000
+    _PRUNE_INTERVAL = 100
+    # Entries are not touched on every load, that would be a write each
+    _TOUCH_INTERVAL = 24 * 60 * 60
+
+    def __init__(self):
+        self._path = None
+        self._queue = None
+        self._stores = 0
+        self._lock = threading.Lock()
+
+    def _get_path(self):
+        with self._lock:
+            if self._path is None:
+                path = env.get_profile_path('icon-cache')
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                self._path = path
+        return self._path
+
+    def _get_file_name(self, key):
+        digest = hashlib.sha1(repr(key)).hexdigest()
+        return os.path.join(self._get_path(), digest)
+
+    def get(self, key):
+        """Get the surface stored for key and the (width, height) of the
+        icon it was rendered from, or None if it is not stored."""
+        try:
+            file_name = self._get_file_name(key)
+            with open(file_name, 'rb') as icon_file:
+                icon_file.seek(-self._TRAILER.size, os.SEEK_END)
+                magic, surface_format, width, height, stride, icon_width, \
+                    icon_height = self._TRAILER.unpack(
+                        icon_file.read(self._TRAILER.size))
+                data_size = stride * height
+                if magic != self._MAGIC or \
+                        data_size + self._TRAILER.size != icon_file.tell():
+                    logging.warning('Invalid icon cache entry %s', file_name)
+                    os.remove(file_name)
+                    return None
+                data = mmap.mmap(icon_file.fileno(), data_size,
+                                 access=mmap.ACCESS_COPY)
+                if os.fstat(icon_file.fileno()).st_mtime < \
+                        time.time() - self._TOUCH_INTERVAL:
+                    os.utime(file_name, None)
+        except (IOError, OSError, struct.error, ValueError):
+            return None
+
+        surface = cairo.ImageSurface.create_for_data(
+            data, surface_format, width, height, stride)
+        return surface, (icon_width, icon_height)
+
+    def set(self, key, surface, icon_size):
+        """Store surface, rendered from an icon of icon_size, for key.
+
+        The entry is written later, the surface must not be drawn on
+        anymore.
+        """
+        surface.flush()
+        with self._lock:
+            if self._queue is None:
+                self._start()
+        self._queue.put((key, surface, icon_size))
+
+    def _start(self):
+        GObject.threads_init()
+        self._queue = Queue.Queue()
+        thread = threading.Thread(target=self._writer)
+        thread.daemon = True
+        thread.start()
+
+    def _writer(self):
+        while True:
+            key, surface, icon_size = self._queue.get()
+            self._write(key, surface, icon_size)
+
+    def _write(self, key, surface, icon_size):
+        icon_width, icon_height = icon_size
+        trailer = self._TRAILER.pack(
+            self._MAGIC, surface.get_format(), surface.get_width(),
+            surface.get_height(), surface.get_stride(), int(icon_width),
+            int(icon_height))
+        temp_file_name = None
+        try:
+            file_name = self._get_file_name(key)
+            # Hidden until it is complete, so that it is not pruned
+            fd, temp_file_name = tempfile.mkstemp(dir=self._get_path(),
+                                                  prefix='.')
+            with os.fdopen(fd, 'wb') as icon_file:
+                icon_file.write(surface.get_data())
+                icon_file.write(trailer)
+            os.rename(temp_file_name, file_name)
+        except (IOError, OSError):
+            logging.exception('Could not write icon cache entry')
+            if temp_file_name is not None and os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            return
+
+        self._stores += 1
+        if self._stores % self._PRUNE_INTERVAL == 0:
+            self._prune()
+
+    def _prune(self):
+        path = self._get_path()
+        entries = []
+        try:
+            for name in os.listdir(path):
+                entry = os.path.join(path, name)
+                try:
+                    mtime = os.stat(entry).st_mtime
+                except OSError:
+                    # Pruned by another process meanwhile
+                    continue
+                if not name.startswith('.'):
+                    entries.append((mtime, entry))
+                elif mtime < time.time() - self._TOUCH_INTERVAL:
+                    # Left over by a process that did not complete it
+                    os.remove(entry)
+
+            entries.sort()
+            for mtime_, entry in entries[:-self._MAX_ENTRIES]:
+                os.remove(entry)
+        except OSError:
+            logging.exception('Could not prune the icon cache')
+
+
+class _IconAtlas(object):
+    """Rendered icon surfaces shared by all the processes of the user.
+
+    The atlas is a single file with the pixels of every icon stored at an
+    offset aligned to the mmap granularity, followed by a JSON index and a
+    trailer. Surfaces are created directly over the mapped pixels, so all
+    the processes using the same icons share the same physical pages. It
+    has a directory of its own, the disk cache prunes its directory.
+    """
+
+    _TRAILER = struct.Struct('<4sI')
+    _MAGIC = 'SIA1'
+    _RETRY_INTERVAL = 30
+
+    def __init__(self):
+        self._file = None
+        self._index = None
+        self._last_load = 0
+
+    def _get_path(self):
+        return os.path.join(env.get_profile_path('icon-atlas'), 'atlas')
+
+    def _load(self):
+        self._last_load = time.time()
+        try:
+            atlas_file = open(self._get_path(), 'rb')
+        except IOError:
+            return
+
+        try:
+            atlas_file.seek(-self._TRAILER.size, os.SEEK_END)
+            magic, index_size = self._TRAILER.unpack(
+                atlas_file.read(self._TRAILER.size))
+            if magic != self._MAGIC:
+                raise ValueError('Invalid magic %r' % magic)
+            atlas_file.seek(-self._TRAILER.size - index_size, os.SEEK_END)
+            index = json.loads(atlas_file.read(index_size))
+        except (IOError, struct.error, ValueError):
+            logging.exception('Could not load the icon atlas')
+            atlas_file.close()
+            return
+
+        self._file = atlas_file
+        self._index = index
+
+    def reload(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._index = None
+        self._load()
+
+    def get(self, cache_key):
+        if self._index is None:
+            if time.time() - self._last_load < self._RETRY_INTERVAL:
+                return None
+            self._load()
+            if self._index is None:
+                return None
+
+        key = repr(cache_key)
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+
+        if self._is_stale(entry):
+            # Not checked again until the atlas is rebuilt
+            del self._index[key]
+            self._reload_if_replaced()
+            return None
+
+        try:
+            data = mmap.mmap(self._file.fileno(),
+                             entry['stride'] * entry['height'],
+                             access=mmap.ACCESS_COPY,
+                             offset=entry['offset'])
+        except (OSError, mmap.error, ValueError):
+            return None
+
+        return cairo.ImageSurface.create_for_data(
+            data, entry['format'], entry['width'], entry['height'],
+            entry['stride'])
+
+    def create(self, entries):
+        """Write a new atlas with entries, a list of
+        (cache_key, file_name, surface) tuples."""
+        path = self._get_path()
+        temp_path = None
+        index = {}
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                             prefix='.')
+            with os.fdopen(fd, 'wb') as atlas_file:
+                for cache_key, file_name, surface in entries:
+                    offset = atlas_file.tell()
+                    padding = -offset % mmap.ALLOCATIONGRANULARITY
+                    atlas_file.write('\0' * padding)
+                    surface.flush()
+                    index[repr(cache_key)] = {
+                        'file_name': file_name,
+                        'mtime': os.stat(file_name).st_mtime,
+                        'offset': offset + padding,
+                        'format': surface.get_format(),
+                        'width': surface.get_width(),
+                        'height': surface.get_height(),
+                        'stride': surface.get_stride(),
+                    }
+                    atlas_file.write(surface.get_data())
+
+                index_data = json.dumps(index)
+                atlas_file.write(index_data)
+                atlas_file.write(
+                    self._TRAILER.pack(self._MAGIC, len(index_data)))
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            logging.exception('Could not write the icon atlas')
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        self.reload()
+
+    def _is_stale(self, entry):
+        try:
+            return os.stat(entry['file_name']).st_mtime != entry['mtime']
+        except OSError:
+            return True
+
+    def _reload_if_replaced(self):
+        try:
+            replaced = os.stat(self._get_path()).st_ino != \
+                os.fstat(self._file.fileno()).st_ino
+        except OSError:
+            return
+        if replaced:
+            self.reload()
+
+    def is_stale(self):
+        """Whether the atlas is missing or any of its icons has changed
+        since it was written."""
+        self.reload()
+        if self._index is None:
+            return True
+        for entry in self._index.values():
+            if self._is_stale(entry):
+                return True
+        return False
+
+
+class _RenderProfile(object):
+    """The slowest icon cache misses, to find the icons worth optimizing."""
+
+    def __init__(self, count):
+        self._count = count
+        self._renders = []
+        self._lock = threading.Lock()
+
+    def add(self, milliseconds, icon_buffer, sensitive):
+        render = (milliseconds, icon_buffer.icon_name or icon_buffer.file_name,
+                  icon_buffer.width, icon_buffer.height, sensitive)
+        with self._lock:
+            if len(self._renders) < self._count:
+                heapq.heappush(self._renders, render)
+            else:
+                heapq.heappushpop(self._renders, render)
+
+    def get_slowest(self):
+        with self._lock:
+            return sorted(self._renders, reverse=True)
+
+    def log(self):
+        for render in self.get_slowest():
+            logging.debug('Icon %s (%sx%s, sensitive %s) took %.1f ms',
+                          render[1], render[2], render[3], render[4],
+                          render[0])
+
+
+_render_profile = None
+
+
+class _IconThemeIndex(object):
+    """Cache of the lookups in the default icon theme.
+
+    Icon files and attach points are cached per (icon_name, size), and the
+    levels available for icons named like battery-050 are indexed per base
+    name. Everything is dropped when the theme changes.
+    """
+
+    _LEVEL_RE = re.compile(r'^(.+)-(\d{3})$')
+
+    def __init__(self):
+        self._theme = None
+        self._lookups = {}
+        self._levels = None
+
+    def _get_theme(self):
+        theme = Gtk.IconTheme.get_default()
+        if theme is not self._theme:
+            self._theme = theme
+            theme.connect('changed', self.__theme_changed_cb)
+            self._lookups = {}
+            self._levels = None
+        return theme
+
+    def __theme_changed_cb(self, theme):
+        self._lookups = {}
+        self._levels = None
+
+    def lookup(self, icon_name, size):
+        """Return (file_name, attach_x, attach_y) of the icon, with the
+        attach points relative to size, or None if the icon is not in the
+        theme."""
+        theme = self._get_theme()
+
+        key = (icon_name, size)
+        if key in self._lookups:
+            return self._lookups[key]
+
+        info = theme.lookup_icon(icon_name, size, 0)
+        if info is None:
+            result = None
+        else:
+            has_attach_points_, attach_points = info.get_attach_points()
+            if attach_points:
+                attach_x = float(attach_points[0].x) / size
+                attach_y = float(attach_points[0].y) / size
+            else:
+                attach_x = attach_y = 0
+            result = (info.get_filename(), attach_x, attach_y)
+            del info
+
+        self._lookups[key] = result
+        return result
+
+    def get_levels(self, base_name):
+        """Return the sorted levels available for base_name, or None if
+        there are none."""
+        theme = self._get_theme()
+
+        if self._levels is None:
+            self._levels = {}
+            for icon_name in theme.list_icons(None):
+                match = self._LEVEL_RE.match(icon_name)
+                if match:
+                    self._levels.setdefault(match.group(1), []).append(
+                        int(match.group(2)))
+            for levels in self._levels.values():
+                levels.sort()
+
+        return self._levels.get(base_name)
+
+
+_icon_theme_index = _IconThemeIndex()
 
 
 class _IconInfo(object):
@@ -85,8 +591,16 @@ class _BadgeInfo(object):
 
 class _IconBuffer(object):
 
-    _surface_cache = LRU(50)
+    _surface_cache = SizedLRU(
+        _get_cache_size('SUGAR_ICON_SURFACE_CACHE_SIZE', 8 * 1024),
+        _get_cached_size)
+    _disk_cache = _SurfaceDiskCache()
+    _atlas = _IconAtlas()
     _loader = _SVGLoader()
+    # Intrinsic size of the icon files, to composite badges
+    _icon_sizes = {}
+    # Drawn while icons are rendered asynchronously, by size
+    _placeholders = {}
 
     def __init__(self):
         self.icon_name = None
@@ -100,18 +614,29 @@ class _IconBuffer(object):
         self.height = None
         self.cache = False
         self.scale = 1.0
+        self.device_scale = 1
         self.pixbuf = None
 
-    def _get_cache_key(self, sensitive):
+    def _get_background_key(self):
         if self.background_color is None:
-            color = None
-        else:
-            color = (self.background_color.red, self.background_color.green,
-                     self.background_color.blue)
+            return None
+        return (self.background_color.red, self.background_color.green,
+                self.background_color.blue)
 
+    def _get_cache_key(self, sensitive):
         return (self.icon_name, self.file_name, self.pixbuf, self.fill_color,
                 self.stroke_color, self.badge_name, self.width, self.height,
-                color, sensitive)
+                self._get_background_key(), self.device_scale, sensitive)
+
+    def _get_disk_cache_key(self, file_name):
+        try:
+            mtime = os.stat(file_name).st_mtime
+        except OSError:
+            return None
+
+        return (file_name, mtime, self.fill_color, self.stroke_color,
+                self.badge_name, self.width, self.height, self.scale,
+                self._get_background_key(), self.device_scale)
 
     def _load_svg(self, file_name):
         entities = {}
@@ -122,69 +647,95 @@ class _IconBuffer(object):
 
         return self._loader.load(file_name, entities, self.cache)
 
-    def _get_attach_points(self, info, size_request):
-        has_attach_points_, attach_points = info.get_attach_points()
-
-        if attach_points:
-            attach_x = float(attach_points[0].x) / size_request
-            attach_y = float(attach_points[0].y) / size_request
-        else:
-            attach_x = attach_y = 0
-
-        return attach_x, attach_y
-
     def _get_icon_info(self, file_name, icon_name):
         icon_info = _IconInfo()
 
         if file_name:
             icon_info.file_name = file_name
         elif icon_name:
-            theme = Gtk.IconTheme.get_default()
-
             size = 50
             if self.width is not None:
                 size = self.width
 
-            info = theme.lookup_icon(icon_name, int(size), 0)
+            info = _icon_theme_index.lookup(icon_name, int(size))
             if info:
-                attach_x, attach_y = self._get_attach_points(info, size)
-
-                icon_info.file_name = info.get_filename()
-                icon_info.attach_x = attach_x
-                icon_info.attach_y = attach_y
-
-                del info
+                icon_info.file_name, icon_info.attach_x, icon_info.attach_y = \
+                    info
             else:
                 logging.warning('No icon with the name %s was found in the '
                                 'theme.', icon_name)
 
         return icon_info
 
-    def _draw_badge(self, context, size, sensitive, widget):
-        theme = Gtk.IconTheme.get_default()
-        badge_info = theme.lookup_icon(self.badge_name, int(size), 0)
+    def _draw_badge(self, context, size):
+        badge_info = _icon_theme_index.lookup(self.badge_name, int(size))
         if badge_info:
-            badge_file_name = badge_info.get_filename()
+            badge_file_name = badge_info[0]
             if badge_file_name.endswith('.svg'):
                 handle = self._loader.load(badge_file_name, {}, self.cache)
 
-                icon_width = handle.props.width
-                icon_height = handle.props.height
-
-                pixbuf = handle.get_pixbuf()
+                context.scale(float(size) / handle.props.width,
+                              float(size) / handle.props.height)
+                handle.render_cairo(context)
             else:
                 pixbuf = GdkPixbuf.Pixbuf.new_from_file(badge_file_name)
 
-                icon_width = pixbuf.get_width()
-                icon_height = pixbuf.get_height()
+                context.scale(float(size) / pixbuf.get_width(),
+                              float(size) / pixbuf.get_height())
+                Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
+                context.paint()
 
-            context.scale(float(size) / icon_width,
-                          float(size) / icon_height)
+    def _composite_badge(self):
+        """Composite the cached surfaces of the icon and of its badge.
 
-            if not sensitive:
-                pixbuf = self._get_insensitive_pixbuf(pixbuf, widget)
-            Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
-            context.paint()
+        Changing the badge of an icon then only renders the badge, if it is
+        not cached yet. Returns None if the badge does not fit in the icon
+        surface or the size of the icon is not known yet.
+        """
+        if self.pixbuf:
+            return None
+
+        icon_info = self._get_icon_info(self.file_name, self.icon_name)
+        if icon_info.file_name not in self._icon_sizes:
+            return None
+
+        icon_width, icon_height = self._icon_sizes[icon_info.file_name]
+        badge_info = self._get_badge_info(icon_info, icon_width, icon_height)
+        if badge_info.icon_padding:
+            return None
+
+        icon = _IconBuffer()
+        icon.__dict__.update(self.__dict__)
+        icon.badge_name = None
+        surface = icon.get_surface()
+        if surface is None:
+            return None
+
+        width, height = self._get_size(icon_width, icon_height, 0)
+        x_scale = float(width) / icon_width
+        y_scale = float(height) / icon_height
+
+        badge = _IconBuffer()
+        badge.icon_name = self.badge_name
+        badge.width = badge_info.size * x_scale
+        badge.height = badge_info.size * y_scale
+        badge.device_scale = self.device_scale
+        badge.cache = self.cache
+        badge_surface = badge.get_surface()
+        if badge_surface is None:
+            return None
+
+        badged_surface = self._create_surface(surface.get_format(),
+                                              width, height)
+        context = cairo.Context(badged_surface)
+        context.set_source_surface(surface, 0, 0)
+        context.paint()
+        context.set_source_surface(badge_surface,
+                                   round(badge_info.attach_x * x_scale),
+                                   round(badge_info.attach_y * y_scale))
+        context.paint()
+
+        return badged_surface
 
     def _get_size(self, icon_width, icon_height, padding):
         if self.width is not None and self.height is not None:
@@ -229,31 +780,147 @@ class _IconBuffer(object):
             self.stroke_color = None
             self.fill_color = None
 
-    def _get_insensitive_pixbuf(self, pixbuf, widget):
-        if not (widget and widget.get_style()):
-            return pixbuf
+    def _create_surface(self, surface_format, width, height):
+        # The size is in logical pixels, the surface has the pixels of the
+        # device scale
+        surface = cairo.ImageSurface(
+            surface_format, int(math.ceil(width * self.device_scale)),
+            int(math.ceil(height * self.device_scale)))
+        if self.device_scale != 1:
+            surface.set_device_scale(self.device_scale, self.device_scale)
+        return surface
 
-        icon_source = Gtk.IconSource()
-        # Special size meaning "don't touch"
-        icon_source.set_size(-1)
-        icon_source.set_pixbuf(pixbuf)
-        icon_source.set_state(Gtk.StateType.INSENSITIVE)
-        icon_source.set_direction_wildcarded(False)
-        icon_source.set_size_wildcarded(False)
+    def _get_insensitive_surface(self, surface):
+        width = surface.get_width()
+        height = surface.get_height()
+
+        # Desaturate the icon, keeping its luminosity and alpha
+        gray_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        if self.device_scale != 1:
+            gray_surface.set_device_scale(self.device_scale,
+                                          self.device_scale)
+        context = cairo.Context(gray_surface)
+        context.set_source_surface(surface, 0, 0)
+        context.paint()
+        context.set_operator(cairo.OPERATOR_HSL_SATURATION)
+        context.set_source_rgb(0, 0, 0)
+        context.mask_surface(surface, 0, 0)
+
+        insensitive_surface = cairo.ImageSurface(surface.get_format(),
+                                                 width, height)
+        if self.device_scale != 1:
+            insensitive_surface.set_device_scale(self.device_scale,
+                                                 self.device_scale)
+        context = cairo.Context(insensitive_surface)
+        if self.background_color is not None:
+            context.set_source_color(self.background_color)
+            context.paint()
+        context.set_source_surface(gray_surface, 0, 0)
+        context.paint_with_alpha(_INSENSITIVE_ALPHA)
 
-        widget_style = widget.get_style()
-        pixbuf = widget_style.render_icon(
-            icon_source, widget.get_direction(),
-            Gtk.StateType.INSENSITIVE, -1, widget,
-            'sugar-icon')
+        return insensitive_surface
 
-        return pixbuf
+    def _get_icon_candidates(self):
+        # We run two attempts at finding the icon. First, we try the icon
+        # requested by the user. If that fails, we fall back on
+        # document-generic.
+        return ((self.file_name, self.icon_name), (None, 'document-generic'))
 
     def get_surface(self, sensitive=True, widget=None):
         cache_key = self._get_cache_key(sensitive)
         if cache_key in self._surface_cache:
             return self._surface_cache[cache_key]
 
+        start = time.time()
+        if sensitive:
+            surface = self._get_atlas_surface(cache_key)
+            if surface is None and self.badge_name:
+                surface = self._composite_badge()
+            if surface is None:
+                surface = self._render()
+        else:
+            # Derived from the sensitive surface, so toggling the
+            # sensitivity does not render the icon again
+            surface = self.get_surface(True)
+            if surface is not None:
+                surface = self._get_insensitive_surface(surface)
+
+        if surface is not None:
+            self._surface_cache[cache_key] = surface
+
+        if _render_profile is not None:
+            _render_profile.add((time.time() - start) * 1000, self, sensitive)
+
+        return surface
+
+    def _get_atlas_surface(self, cache_key):
+        if self.pixbuf is not None:
+            return None
+        return self._atlas.get(cache_key)
+
+    def get_surface_async(self, callback, sensitive=True):
+        """Get the surface without rendering it in the main thread.
+
+        If the surface is not cached yet, it is rendered by a worker thread
+        and None is returned; callback is then called from the main loop
+        once the surface is available from the cache. The insensitive
+        surface is derived from the sensitive one once that is rendered.
+        Icons with a pixbuf or a badge need the icon theme while rendering,
+        so they are rendered synchronously.
+
+        """
+        cache_key = self._get_cache_key(sensitive)
+        if cache_key in self._surface_cache:
+            return self._surface_cache[cache_key]
+
+        if self.pixbuf or self.badge_name:
+            return self.get_surface(sensitive)
+
+        if not sensitive:
+            surface = self.get_surface_async(callback)
+            if surface is not None:
+                surface = self._get_insensitive_surface(surface)
+                self._surface_cache[cache_key] = surface
+            return surface
+
+        surface = self._get_atlas_surface(cache_key)
+        if surface is not None:
+            self._surface_cache[cache_key] = surface
+            return surface
+
+        _async_renderer.render(_IconBufferSnapshot(self), cache_key, callback)
+        return None
+
+    def get_placeholder_surface(self):
+        """Get a neutral surface of the size of the icon, to draw while the
+        icon is rendered asynchronously, or None if the size is not set."""
+        if not self.width or not self.height:
+            return None
+
+        key = (self.width, self.height, self.device_scale)
+        surface = self._placeholders.get(key)
+        if surface is None:
+            surface = self._create_surface(cairo.FORMAT_ARGB32, self.width,
+                                           self.height)
+            context = cairo.Context(surface)
+            radius = min(self.width, self.height) / 4.0
+            context.new_sub_path()
+            context.arc(self.width - radius, radius, radius,
+                        -math.pi / 2, 0)
+            context.arc(self.width - radius, self.height - radius, radius,
+                        0, math.pi / 2)
+            context.arc(radius, self.height - radius, radius,
+                        math.pi / 2, math.pi)
+            context.arc(radius, radius, radius, math.pi, 3 * math.pi / 2)
+            context.close_path()
+            r, g, b, a_ = style.COLOR_BUTTON_GREY.get_rgba()
+            context.set_source_rgba(r, g, b, _INSENSITIVE_ALPHA)
+            context.fill()
+            self._placeholders[key] = surface
+        return surface
+
+    def _render(self, cache_on_disk=True):
+        disk_cache_key = None
         if self.pixbuf:
             # We alredy have the pixbuf for this icon.
             pixbuf = self.pixbuf
@@ -262,12 +929,9 @@ class _IconBuffer(object):
             icon_info = self._get_icon_info(self.file_name, self.icon_name)
             is_svg = False
         else:
-            # We run two attempts at finding the icon. First, we try the icon
-            # requested by the user. If that fails, we fall back on
-            # document-generic. If that doesn't work out, bail.
+            # If none of the candidates works out, bail.
             icon_width = None
-            for (file_name, icon_name) in ((self.file_name, self.icon_name),
-                                           (None, 'document-generic')):
+            for (file_name, icon_name) in self._get_icon_candidates():
                 icon_info = self._get_icon_info(file_name, icon_name)
                 if icon_info.file_name is None:
                     return None
@@ -275,6 +939,17 @@ class _IconBuffer(object):
                 is_svg = icon_info.file_name.endswith('.svg')
 
                 if is_svg:
+                    disk_cache_key = self._get_disk_cache_key(
+                        icon_info.file_name)
+                    if disk_cache_key is not None:
+                        cached = self._disk_cache.get(disk_cache_key)
+                        if cached is not None:
+                            surface, icon_size = cached
+                            self._icon_sizes[icon_info.file_name] = icon_size
+                            if self.device_scale != 1:
+                                surface.set_device_scale(self.device_scale,
+                                                         self.device_scale)
+                            return surface
                     try:
                         handle = self._load_svg(icon_info.file_name)
                         icon_width = handle.props.width
@@ -296,17 +971,20 @@ class _IconBuffer(object):
             # Neither attempt found an icon for us to use
             return None
 
+        if not self.pixbuf:
+            self._icon_sizes[icon_info.file_name] = (icon_width, icon_height)
+
         badge_info = self._get_badge_info(icon_info, icon_width, icon_height)
 
         padding = badge_info.icon_padding
         width, height = self._get_size(icon_width, icon_height, padding)
         if self.background_color is None:
-            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width),
-                                         int(height))
+            surface = self._create_surface(cairo.FORMAT_ARGB32, int(width),
+                                           int(height))
             context = cairo.Context(surface)
         else:
-            surface = cairo.ImageSurface(cairo.FORMAT_RGB24, int(width),
-                                         int(height))
+            surface = self._create_surface(cairo.FORMAT_RGB24, int(width),
+                                           int(height))
             context = cairo.Context(surface)
             context.set_source_color(self.background_color)
             context.paint()
@@ -317,32 +995,113 @@ class _IconBuffer(object):
 
         context.translate(padding, padding)
         if is_svg:
-            if sensitive:
-                handle.render_cairo(context)
-            else:
-                pixbuf = handle.get_pixbuf()
-                pixbuf = self._get_insensitive_pixbuf(pixbuf, widget)
-
-                Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
-                context.paint()
+            handle.render_cairo(context)
         else:
-            if not sensitive:
-                pixbuf = self._get_insensitive_pixbuf(pixbuf, widget)
             Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
             context.paint()
 
         if self.badge_name:
             context.restore()
             context.translate(badge_info.attach_x, badge_info.attach_y)
-            self._draw_badge(context, badge_info.size, sensitive, widget)
+            self._draw_badge(context, badge_info.size)
 
-        self._surface_cache[cache_key] = surface
+        if is_svg and disk_cache_key is not None and cache_on_disk:
+            self._disk_cache.set(disk_cache_key, surface,
+                                 (icon_width, icon_height))
 
         return surface
 
     xo_color = property(_get_xo_color, _set_xo_color)
 
 
+class _IconBufferSnapshot(_IconBuffer):
+    """A copy of an _IconBuffer that can be rendered off the main thread.
+
+    The icon theme may only be used from the main thread, so the icon
+    lookups are resolved when the snapshot is taken.
+    """
+
+    def __init__(self, icon_buffer):
+        _IconBuffer.__init__(self)
+        self.__dict__.update(icon_buffer.__dict__)
+
+        self._icon_infos = {}
+        for file_name, icon_name in self._get_icon_candidates():
+            self._icon_infos[(file_name, icon_name)] = \
+                _IconBuffer._get_icon_info(self, file_name, icon_name)
+
+    def _get_icon_info(self, file_name, icon_name):
+        return self._icon_infos[(file_name, icon_name)]
+
+    def render(self, loader):
+        self._loader = loader
+        return self._render()
+
+
+class _AsyncRenderer(object):
+    """Pool of worker threads rasterizing icons off the main thread.
+
+    Each worker has its own SVG loader, as Rsvg handles can not be shared
+    between threads. Finished surfaces are stored in the surface cache from
+    the main loop, so the cache is only ever accessed from the main thread.
+    """
+
+    _WORKERS = 2
+
+    def __init__(self):
+        self._queue = None
+        self._pending = {}
+
+    def _start(self):
+        GObject.threads_init()
+        self._queue = Queue.Queue()
+        for i_ in range(self._WORKERS):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+
+    def render(self, snapshot, cache_key, callback):
+        if cache_key in self._pending:
+            self._pending[cache_key].append(callback)
+            return
+
+        if self._queue is None:
+            self._start()
+
+        self._pending[cache_key] = [callback]
+        self._queue.put((cache_key, snapshot))
+
+    def _worker(self):
+        loader = _SVGLoader()
+        while True:
+            cache_key, snapshot = self._queue.get()
+            start = time.time()
+            try:
+                surface = snapshot.render(loader)
+            except Exception:
+                logging.exception('Could not render icon %s',
+                                  snapshot.icon_name or snapshot.file_name)
+                surface = None
+            if _render_profile is not None:
+                _render_profile.add((time.time() - start) * 1000, snapshot,
+                                    True)
+            GLib.idle_add(self._finish, cache_key, surface)
+
+    def _finish(self, cache_key, surface):
+        callbacks = self._pending.pop(cache_key, [])
+        # Nothing was found, the callers would only schedule it again
+        if surface is None:
+            return False
+
+        _IconBuffer._surface_cache[cache_key] = surface
+        for callback in callbacks:
+            callback()
+        return False
+
+
+_async_renderer = _AsyncRenderer()
+
+
 class Icon(Gtk.Image):
 
     __gtype_name__ = 'SugarIcon'
@@ -359,6 +1118,7 @@ class Icon(Gtk.Image):
         self._file = None
         self._alpha = 1.0
         self._scale = 1.0
+        self._asynchronous = False
 
         # FIXME: deprecate icon_size
         if 'icon_size' in kwargs:
@@ -407,6 +1167,19 @@ class Icon(Gtk.Image):
             self._buffer.width = width
             self._buffer.height = height
 
+        self._buffer.device_scale = self._get_device_scale()
+
+    def _get_device_scale(self):
+        if not _HAS_DEVICE_SCALE:
+            return 1
+
+        # Render zoomed in icons at their drawn size instead of scaling
+        # them up when drawing
+        device_scale = self.get_scale_factor()
+        if self._scale > 1:
+            device_scale *= math.ceil(self._scale * 2) / 2.0
+        return device_scale
+
     def _icon_size_changed_cb(self, image, pspec):
         self._buffer.icon_size = self.props.icon_size
 
@@ -416,11 +1189,16 @@ class Icon(Gtk.Image):
     def _file_changed_cb(self, image, pspec):
         self._buffer.file_name = self.props.file
 
+    def _get_size_surface(self):
+        if self._asynchronous:
+            return self._buffer.get_surface_async(self.queue_resize)
+        return self._buffer.get_surface()
+
     def do_get_preferred_height(self):
         self._sync_image_properties()
-        surface = self._buffer.get_surface()
+        surface = self._get_size_surface()
         if surface:
-            height = surface.get_height()
+            width_, height = _get_surface_logical_size(surface)
         elif self._buffer.height:
             height = self._buffer.height
         else:
@@ -429,9 +1207,9 @@ class Icon(Gtk.Image):
 
     def do_get_preferred_width(self):
         self._sync_image_properties()
-        surface = self._buffer.get_surface()
+        surface = self._get_size_surface()
         if surface:
-            width = surface.get_width()
+            width, height_ = _get_surface_logical_size(surface)
         elif self._buffer.width:
             width = self._buffer.width
         else:
@@ -441,7 +1219,13 @@ class Icon(Gtk.Image):
     def do_draw(self, cr):
         self._sync_image_properties()
         sensitive = (self.is_sensitive())
-        surface = self._buffer.get_surface(sensitive, self)
+        if self._asynchronous:
+            surface = self._buffer.get_surface_async(self.queue_draw,
+                                                     sensitive)
+            if surface is None:
+                surface = self._buffer.get_placeholder_surface()
+        else:
+            surface = self._buffer.get_surface(sensitive, self)
         if surface is None:
             return
 
@@ -533,6 +1317,16 @@ class Icon(Gtk.Image):
     scale = GObject.property(
         type=float, setter=set_scale)
 
+    def set_asynchronous(self, value):
+        self._asynchronous = value
+
+    def get_asynchronous(self):
+        return self._asynchronous
+
+    asynchronous = GObject.property(
+        type=bool, default=False, getter=get_asynchronous,
+        setter=set_asynchronous)
+
 
 class EventIcon(Gtk.EventBox):
     """
@@ -545,6 +1339,7 @@ class EventIcon(Gtk.EventBox):
     def __init__(self, **kwargs):
         self._buffer = _IconBuffer()
         self._alpha = 1.0
+        self._asynchronous = False
 
         Gtk.EventBox.__init__(self)
         self.set_visible_window(False)
@@ -560,13 +1355,24 @@ class EventIcon(Gtk.EventBox):
         self._palette_invoker.attach(self)
         self.connect('destroy', self.__destroy_cb)
 
+    def _get_surface(self, callback):
+        if _HAS_DEVICE_SCALE:
+            self._buffer.device_scale = self.get_scale_factor()
+
+        if self._asynchronous:
+            return self._buffer.get_surface_async(callback)
+        return self._buffer.get_surface()
+
     def do_draw(self, cr):
-        surface = self._buffer.get_surface()
+        surface = self._get_surface(self.queue_draw)
+        if surface is None and self._asynchronous:
+            surface = self._buffer.get_placeholder_surface()
         if surface:
             allocation = self.get_allocation()
+            width, height = _get_surface_logical_size(surface)
 
-            x = (allocation.width - surface.get_width()) / 2
-            y = (allocation.height - surface.get_height()) / 2
+            x = (allocation.width - width) / 2
+            y = (allocation.height - height) / 2
 
             cr.set_source_surface(surface, x, y)
             if self._alpha == 1.0:
@@ -575,9 +1381,9 @@ class EventIcon(Gtk.EventBox):
                 cr.paint_with_alpha(self._alpha)
 
     def do_get_preferred_height(self):
-        surface = self._buffer.get_surface()
+        surface = self._get_surface(self.queue_resize)
         if surface:
-            height = surface.get_height()
+            width_, height = _get_surface_logical_size(surface)
         elif self._buffer.height:
             height = self._buffer.height
         else:
@@ -585,9 +1391,9 @@ class EventIcon(Gtk.EventBox):
         return (height, height)
 
     def do_get_preferred_width(self):
-        surface = self._buffer.get_surface()
+        surface = self._get_surface(self.queue_resize)
         if surface:
-            width = surface.get_width()
+            width, height_ = _get_surface_logical_size(surface)
         elif self._buffer.width:
             width = self._buffer.width
         else:
@@ -701,6 +1507,16 @@ class EventIcon(Gtk.EventBox):
     cache = GObject.property(
         type=bool, default=False, getter=get_cache, setter=set_cache)
 
+    def set_asynchronous(self, value):
+        self._asynchronous = value
+
+    def get_asynchronous(self):
+        return self._asynchronous
+
+    asynchronous = GObject.property(
+        type=bool, default=False, getter=get_asynchronous,
+        setter=set_asynchronous)
+
     def set_badge_name(self, value):
         if self._buffer.badge_name != value:
             self._buffer.badge_name = value
@@ -800,6 +1616,181 @@ class CanvasIcon(EventIcon):
         self.unset_state_flags(Gtk.StateFlags.PRELIGHT)
 
 
+class _PackedIcon(object):
+    """An icon rendered in several colors, packed in one surface.
+
+    Each (fill, stroke) color pair is rendered the first time it is drawn,
+    into a slot of a grid at most columns slots wide. The surface doubles
+    in size when it is full, and the slots of removed colors are reused.
+    """
+
+    def __init__(self, icon_buffer, columns):
+        self._icon = _IconBuffer()
+        self._icon.__dict__.update(icon_buffer.__dict__)
+        self._max_columns = columns
+
+        self.surface = None
+        self.failed = False
+        self._width = 0
+        self._height = 0
+        self._columns = 0
+        self._capacity = 0
+        self._count = 0
+        self._free = []
+        self._indexes = {}
+
+    def _get_slot(self, index, columns=None):
+        if columns is None:
+            columns = self._columns
+        return ((index % columns) * self._width,
+                (index / columns) * self._height,
+                self._width, self._height)
+
+    def _grow(self, surface_format):
+        capacity = max(2 * self._capacity, 1)
+        columns = min(capacity, self._max_columns)
+        rows = int(math.ceil(capacity / float(columns)))
+
+        surface = cairo.ImageSurface(surface_format, self._width * columns,
+                                     self._height * rows)
+        if self.surface is not None:
+            # The grid gets wider while it has less than a row, the slots
+            # are moved one by one
+            context = cairo.Context(surface)
+            context.set_operator(cairo.OPERATOR_SOURCE)
+            for index in range(self._count):
+                x, y, width, height = self._get_slot(index)
+                new_x, new_y, width, height = self._get_slot(index, columns)
+                context.set_source_surface(self.surface, new_x - x,
+                                           new_y - y)
+                context.rectangle(new_x, new_y, width, height)
+                context.fill()
+
+        self.surface = surface
+        self._columns = columns
+        self._capacity = capacity
+
+    def add(self, colors):
+        """Render the icon in the colors, return their slot"""
+        if self.failed:
+            return None
+
+        self._icon.fill_color, self._icon.stroke_color = colors
+        # Only the packed surface is kept, every color of every icon would
+        # fill the disk cache
+        rendered = self._icon._render(cache_on_disk=False)
+        if rendered is None:
+            self.failed = True
+            return None
+
+        if self._free:
+            index = self._free.pop()
+        else:
+            if self.surface is None:
+                self._width = rendered.get_width()
+                self._height = rendered.get_height()
+            if self._count == self._capacity:
+                self._grow(rendered.get_format())
+            index = self._count
+            self._count += 1
+
+        slot = self._get_slot(index)
+        context = cairo.Context(self.surface)
+        context.rectangle(*slot)
+        context.clip()
+        # Replace the pixels of any removed colors
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.set_source_surface(rendered, slot[0], slot[1])
+        context.paint()
+
+        self._indexes[colors] = index
+        return slot
+
+    def remove(self, colors):
+        index = self._indexes.pop(colors, None)
+        if index is not None:
+            self._free.append(index)
+
+    def get(self, colors):
+        """Get the slot of the colors, rendering them if needed"""
+        index = self._indexes.get(colors)
+        if index is None:
+            return self.add(colors)
+        return self._get_slot(index)
+
+
+class _CellRendererAtlas(object):
+    """Icons of a CellRendererIcon packed in one surface per icon.
+
+    Each packed surface has a slot per (fill, stroke) color pair drawn by
+    the rows of the model, so rendering a row is a blit of a sub-rectangle
+    instead of a lookup in, or a miss of, the shared surface cache. Colors
+    are rendered the first time a row draws them, and the packed surfaces
+    are kept in the surface cache, within its budget.
+    """
+
+    _COLUMNS = 32
+
+    def __init__(self):
+        self._colors = set()
+        # The packed icons are owned by the surface cache
+        self._icons = weakref.WeakValueDictionary()
+        # Keys of the packed icons of this atlas in the surface cache
+        self._token = object()
+
+    def add_colors(self, colors):
+        for color in colors:
+            if color is not None:
+                self._colors.add(color)
+
+    def set_colors(self, colors):
+        """Use only the colors given, free the slots of the others"""
+        colors = set(color for color in colors if color is not None)
+        for removed in self._colors - colors:
+            for packed_icon in self._icons.values():
+                packed_icon.remove(removed)
+        self._colors = colors
+
+    def clear(self):
+        """Drop the packed icons from the surface cache"""
+        surface_cache = _IconBuffer._surface_cache
+        for key in self._icons.keys():
+            if key in surface_cache:
+                del surface_cache[key]
+        self._icons.clear()
+
+    def _get_key(self, icon_buffer):
+        return (self._token, icon_buffer.icon_name, icon_buffer.file_name,
+                icon_buffer.badge_name, icon_buffer.width, icon_buffer.height,
+                icon_buffer._get_background_key())
+
+    def get(self, icon_buffer):
+        """Get the packed surface of the icon and the (x, y, width, height)
+        slot of its colors, or None if they are not in the atlas."""
+        colors = (icon_buffer.fill_color, icon_buffer.stroke_color)
+        if colors not in self._colors:
+            return None
+
+        surface_cache = _IconBuffer._surface_cache
+        key = self._get_key(icon_buffer)
+        packed_icon = None
+        if key in surface_cache:
+            packed_icon = surface_cache[key]
+        if packed_icon is None:
+            packed_icon = _PackedIcon(icon_buffer, self._COLUMNS)
+            surface_cache[key] = packed_icon
+            self._icons[key] = packed_icon
+
+        surface = packed_icon.surface
+        slot = packed_icon.get(colors)
+        if packed_icon.surface is not surface:
+            # Account for the grown surface
+            surface_cache[key] = packed_icon
+        if slot is None:
+            return None
+        return packed_icon.surface, slot
+
+
 class CellRendererIcon(Gtk.CellRenderer):
 
     __gtype_name__ = 'SugarCellRendererIcon'
@@ -820,6 +1811,11 @@ class CellRendererIcon(Gtk.CellRenderer):
         self._prelit_stroke_color = None
         self._active_state = False
         self._palette_invoker = CellRendererInvoker()
+        self._atlas = None
+        self._model = None
+        self._model_sids = []
+        self._xo_color_column = None
+        self._update_colors_sid = None
 
         Gtk.CellRenderer.__init__(self)
 
@@ -833,6 +1829,84 @@ class CellRendererIcon(Gtk.CellRenderer):
     def __del__(self):
         self._palette_invoker.detach()
 
+    def enable_batch_mode(self, model, xo_color_column):
+        """Render the icons from atlases of the colors used in the model.
+
+        The icon is rendered once for every XoColor in the xo_color_column
+        of the model, and for the prelit colors, into one packed surface,
+        the first time a row of that color is drawn. Rows are then drawn
+        from it, which avoids rendering icons again in large tree views
+        with many different row colors. The atlas follows the colors of the
+        new, changed and deleted rows of the model.
+
+        Keyword arguments:
+        model           -- Gtk.TreeModel of the tree view
+        xo_color_column -- number of the column containing the XoColor of
+                           each row
+
+        """
+        self.disable_batch_mode()
+
+        self._atlas = _CellRendererAtlas()
+        self._model = model
+        self._xo_color_column = xo_color_column
+        self._model_sids = [
+            model.connect('row-changed', self.__row_changed_cb),
+            model.connect('row-inserted', self.__row_inserted_cb),
+            model.connect('row-deleted', self.__row_deleted_cb),
+        ]
+        self._atlas.set_colors(self._get_model_colors())
+
+    def disable_batch_mode(self):
+        for sid in self._model_sids:
+            self._model.disconnect(sid)
+        if self._update_colors_sid is not None:
+            GLib.source_remove(self._update_colors_sid)
+            self._update_colors_sid = None
+        self._model_sids = []
+        self._model = None
+        if self._atlas is not None:
+            self._atlas.clear()
+        self._atlas = None
+
+    def _get_model_colors(self):
+        colors = [self._get_prelit_colors()]
+        for row in self._model:
+            colors.append(self._get_row_colors(row[self._xo_color_column]))
+        return colors
+
+    def _queue_update_colors(self):
+        # The colors no row uses anymore are found once the model has
+        # stopped changing
+        if self._update_colors_sid is None:
+            self._update_colors_sid = GLib.idle_add(self.__update_colors_cb)
+
+    def __update_colors_cb(self):
+        self._update_colors_sid = None
+        self._atlas.set_colors(self._get_model_colors())
+        return False
+
+    def _get_row_colors(self, xo_color):
+        if xo_color is None:
+            return (self._fill_color, self._stroke_color)
+        return (xo_color.get_fill_color(), xo_color.get_stroke_color())
+
+    def _get_prelit_colors(self):
+        if None in [self._prelit_fill_color, self._prelit_stroke_color]:
+            return None
+        return (self._prelit_fill_color, self._prelit_stroke_color)
+
+    def __row_inserted_cb(self, model, path, tree_iter):
+        xo_color = model.get_value(tree_iter, self._xo_color_column)
+        self._atlas.add_colors([self._get_row_colors(xo_color)])
+
+    def __row_changed_cb(self, model, path, tree_iter):
+        self.__row_inserted_cb(model, path, tree_iter)
+        self._queue_update_colors()
+
+    def __row_deleted_cb(self, model, path):
+        self._queue_update_colors()
+
     def __button_press_event_cb(self, widget, event):
         if self._point_in_cell_renderer(widget, event.x, event.y):
             self._active_state = True
@@ -884,6 +1958,9 @@ class CellRendererIcon(Gtk.CellRenderer):
     def set_prelit_fill_color(self, value):
         if self._prelit_fill_color != value:
             self._prelit_fill_color = value
+            if self._atlas is not None:
+                self._atlas.add_colors([self._get_prelit_colors()])
+                self._queue_update_colors()
 
     prelit_fill_color = GObject.property(type=object,
                                          setter=set_prelit_fill_color)
@@ -891,6 +1968,9 @@ class CellRendererIcon(Gtk.CellRenderer):
     def set_prelit_stroke_color(self, value):
         if self._prelit_stroke_color != value:
             self._prelit_stroke_color = value
+            if self._atlas is not None:
+                self._atlas.add_colors([self._get_prelit_colors()])
+                self._queue_update_colors()
 
     prelit_stroke_color = GObject.property(type=object,
                                            setter=set_prelit_stroke_color)
@@ -1008,16 +2088,26 @@ class CellRendererIcon(Gtk.CellRenderer):
             self._buffer.fill_color = fill_color
             self._buffer.stroke_color = stroke_color
 
-        surface = self._buffer.get_surface()
-        if surface is None:
-            return
-
         xoffset, yoffset, width_, height_ = self.do_get_size(widget, cell_area)
 
-        x = cell_area.x + xoffset
-        y = cell_area.y + yoffset
+        x = math.floor(cell_area.x + xoffset)
+        y = math.floor(cell_area.y + yoffset)
+
+        atlas_slot = None
+        if self._atlas is not None:
+            atlas_slot = self._atlas.get(self._buffer)
 
-        cr.set_source_surface(surface, math.floor(x), math.floor(y))
+        if atlas_slot is not None:
+            surface, (slot_x, slot_y, slot_width, slot_height) = atlas_slot
+            cr.rectangle(x, y, slot_width, slot_height)
+            cr.clip()
+            x, y = x - slot_x, y - slot_y
+        else:
+            surface = self._buffer.get_surface()
+            if surface is None:
+                return
+
+        cr.set_source_surface(surface, x, y)
         cr.rectangle(cell_area.x, cell_area.y, cell_area.width,
                      cell_area.height)
         cr.clip()
@@ -1026,8 +2116,21 @@ class CellRendererIcon(Gtk.CellRenderer):
 
 def get_icon_state(base_name, perc, step=5):
     strength = round(perc / step) * step
-    icon_theme = Gtk.IconTheme.get_default()
+    if strength < 0 or strength > 100:
+        return None
+
+    levels = _icon_theme_index.get_levels(base_name)
+    if levels is not None:
+        # The first available level from strength, in steps of step
+        index = bisect.bisect_left(levels, strength)
+        for level in levels[index:]:
+            if level > 100:
+                break
+            if (level - strength) % step == 0:
+                return '%s-%03d' % (base_name, level)
+        return None
 
+    icon_theme = Gtk.IconTheme.get_default()
     while strength <= 100 and strength >= 0:
         icon_name = '%s-%03d' % (base_name, strength)
         if icon_theme.has_icon(icon_name):
@@ -1037,13 +2140,10 @@ def get_icon_state(base_name, perc, step=5):
 
 
 def get_icon_file_name(icon_name):
-    icon_theme = Gtk.IconTheme.get_default()
-    info = icon_theme.lookup_icon(icon_name, Gtk.IconSize.LARGE_TOOLBAR, 0)
+    info = _icon_theme_index.lookup(icon_name, int(Gtk.IconSize.LARGE_TOOLBAR))
     if not info:
         return None
-    filename = info.get_filename()
-    del info
-    return filename
+    return info[0]
 
 
 def get_surface(**kwargs):
@@ -1072,3 +2172,160 @@ def get_surface(**kwargs):
     for key, value in kwargs.items():
         icon.__setattr__(key, value)
     return icon.get_surface()
+
+
+def prerender(icons, budget=10):
+    """Render icons into the surface cache while the main loop is idle.
+
+        Icons that are not visible yet, like the ones of palettes and
+        secondary toolbars, can be rendered in advance so that showing them
+        does not stall on rendering. The icons are rendered in chunks from
+        idle callbacks, each spending at most budget milliseconds.
+
+        Keyword arguments:
+        icons  -- list of (icon, size, xo_color, badge_name) tuples, icon is
+                  an icon name or the path of an image file, xo_color and
+                  badge_name can be None
+        budget -- time in milliseconds each idle callback can spend
+                  rendering, default 10
+
+        Return: the id of the idle source, it can be removed to cancel the
+        rendering of the remaining icons
+
+        """
+    pending = list(icons)
+    pending.reverse()
+
+    def __idle_cb():
+        end = time.time() + budget / 1000.0
+        while pending and time.time() < end:
+            icon_name, size, xo_color, badge_name = pending.pop()
+
+            icon = _IconBuffer()
+            if icon_name.startswith('/'):
+                icon.file_name = icon_name
+            else:
+                icon.icon_name = icon_name
+            icon.width = icon.height = size
+            icon.xo_color = xo_color
+            icon.badge_name = badge_name
+            icon.get_surface()
+
+        return bool(pending)
+
+    return GLib.idle_add(__idle_cb)
+
+
+def enable_profiling(count=20):
+    """Record the time taken by the slowest icon cache misses.
+
+        Profiling can also be enabled when the process starts by setting
+        the environment variable SUGAR_ICON_PROFILE to the number of icons
+        to record; they are then logged when the process exits.
+
+        Keyword arguments:
+        count -- number of the slowest icons to keep, default 20
+
+        """
+    global _render_profile
+    _render_profile = _RenderProfile(count)
+
+
+def disable_profiling():
+    global _render_profile
+    _render_profile = None
+
+
+def get_slowest_icons():
+    """Get the slowest icon cache misses since profiling was enabled.
+
+        Return: list of (milliseconds, icon name or file name, width, height,
+        sensitive) tuples, the slowest first
+
+        """
+    if _render_profile is None:
+        return []
+    return _render_profile.get_slowest()
+
+
+def _log_slowest_icons():
+    if _render_profile is not None:
+        _render_profile.log()
+
+
+if 'SUGAR_ICON_PROFILE' in os.environ:
+    try:
+        enable_profiling(int(os.environ['SUGAR_ICON_PROFILE']))
+        atexit.register(_log_slowest_icons)
+    except ValueError:
+        logging.error('Invalid value for SUGAR_ICON_PROFILE')
+
+
+def get_cache_stats():
+    """Get statistics about the in-memory icon caches.
+
+        Return: dictionary with the keys 'surfaces', for the rendered
+        surfaces, and 'svg', for the SVG sources of the icons. Each value
+        is a dictionary with the number of cache 'hits', 'misses' and
+        'evictions', the number of 'entries', their total 'size' in
+        bytes and the 'max_size' in bytes.
+
+        The maximum sizes can be set, in kilobytes, with the environment
+        variables SUGAR_ICON_SURFACE_CACHE_SIZE and
+        SUGAR_ICON_SVG_CACHE_SIZE or with set_cache_size().
+
+        """
+    return {'surfaces': _IconBuffer._surface_cache.get_stats(),
+            'svg': _IconBuffer._loader.get_cache_stats()}
+
+
+def set_cache_size(surfaces=None, svg=None):
+    """Set the maximum size of the in-memory icon caches.
+
+        Keyword arguments:
+        surfaces -- maximum size of the rendered surfaces in bytes,
+                    default None to keep the current size
+        svg      -- maximum size of the SVG sources in bytes,
+                    default None to keep the current size
+
+        """
+    if surfaces is not None:
+        _IconBuffer._surface_cache.set_max_size(surfaces)
+    if svg is not None:
+        _IconBuffer._loader.set_cache_size(svg)
+
+
+def create_atlas(icons, replace=False):
+    """Render icons into the atlas shared by all the processes of the user.
+
+    Surfaces of the icons in the atlas are mapped from a single file
+    instead of being rendered, and kept, by each process. The shell, or
+    the first activity, is expected to populate it with the icons most
+    processes use.
+
+    Keyword arguments:
+    icons   -- list of (icon_name, size, xo_color) tuples, xo_color can
+               be None to use the colors of the icon
+    replace -- replace the atlas even if its icons have not changed,
+               default False
+
+    """
+    atlas = _IconBuffer._atlas
+    if not replace and not atlas.is_stale():
+        return
+
+    entries = []
+    for icon_name, size, xo_color in icons:
+        icon = _IconBuffer()
+        icon.icon_name = icon_name
+        icon.width = icon.height = size
+        icon.xo_color = xo_color
+
+        file_name = icon._get_icon_info(None, icon_name).file_name
+        if file_name is None:
+            continue
+        surface = icon._render()
+        if surface is not None:
+            entries.append((icon._get_cache_key(True), file_name, surface))
+
+    atlas.create(entries)
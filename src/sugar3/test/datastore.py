@@ -0,0 +1,352 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+UNSTABLE.
+
+A stand-in for the data store service, to test and benchmark
+sugar3.datastore without a Sugar session.
+
+It implements the org.laptop.sugar.DataStore interface used by the
+toolkit on top of an SQLite database and a directory of files. The
+service can be run on a private bus:
+
+    bus = start_bus()
+    service = start_service(root_path)
+    ...
+    service.terminate()
+    bus.terminate()
+
+As sugar3.datastore makes blocking calls, the service has to run in
+another process than the client, which start_service() takes care of.
+"""
+
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import uuid
+import shutil
+import sqlite3
+import logging
+import argparse
+import subprocess
+
+import dbus
+import dbus.service
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+DS_DBUS_SERVICE = 'org.laptop.sugar.DataStore'
+DS_DBUS_INTERFACE = 'org.laptop.sugar.DataStore'
+DS_DBUS_PATH = '/org/laptop/sugar/DataStore'
+
+# Properties searched by a fulltext 'query'
+_FULLTEXT_KEYS = ['title', 'description', 'tags']
+
+
+def _to_sql(value):
+    if isinstance(value, dbus.ByteArray):
+        return buffer(str(value))
+    elif isinstance(value, (bool, int, long)):
+        return int(value)
+    elif isinstance(value, float):
+        return value
+    return unicode(value)
+
+
+def _from_sql(value):
+    if isinstance(value, buffer):
+        return dbus.ByteArray(str(value))
+    return value
+
+
+class DataStore(dbus.service.Object):
+    """The data store service, storing its entries under root_path"""
+
+    def __init__(self, root_path):
+        self._files_path = os.path.join(root_path, 'files')
+        self._checkouts_path = os.path.join(root_path, 'checkouts')
+        for path in [self._files_path, self._checkouts_path]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        self._db = sqlite3.connect(os.path.join(root_path, 'datastore.db'))
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                uid TEXT PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS properties (
+                uid TEXT, key TEXT, value,
+                PRIMARY KEY (uid, key));
+            CREATE INDEX IF NOT EXISTS properties_key_value
+                ON properties (key, value);
+            """)
+
+        bus = dbus.SessionBus()
+        bus_name = dbus.service.BusName(DS_DBUS_SERVICE, bus=bus,
+                                        replace_existing=False,
+                                        allow_replacement=False)
+        dbus.service.Object.__init__(self, bus_name, DS_DBUS_PATH)
+
+    def _store_properties(self, uid, props):
+        props = dict(props)
+        props['uid'] = uid
+        self._db.execute('DELETE FROM properties WHERE uid = ?', (uid,))
+        self._db.executemany(
+            'INSERT INTO properties (uid, key, value) VALUES (?, ?, ?)',
+            [(uid, key, _to_sql(value)) for key, value in props.items()])
+
+    def _store_file(self, uid, file_path, transfer_ownership):
+        if not file_path:
+            # The file of the entry is kept
+            return
+
+        destination_path = os.path.join(self._files_path, uid)
+        if transfer_ownership:
+            try:
+                os.rename(file_path, destination_path)
+                return
+            except OSError:
+                logging.debug('Cannot move %s, copying it', file_path)
+
+        shutil.copyfile(file_path, destination_path)
+        if transfer_ownership:
+            os.remove(file_path)
+
+    def _get_properties(self, uid, keys=None):
+        cursor = self._db.execute(
+            'SELECT key, value FROM properties WHERE uid = ?', (uid,))
+        props = {}
+        for key, value in cursor:
+            if not keys or key in keys:
+                props[key] = _from_sql(value)
+        return props
+
+    def _check_uid(self, uid):
+        cursor = self._db.execute('SELECT uid FROM entries WHERE uid = ?',
+                                  (uid,))
+        if cursor.fetchone() is None:
+            raise ValueError('Unknown entry %s' % uid)
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}sb', out_signature='s',
+                         byte_arrays=True)
+    def create(self, props, file_path, transfer_ownership):
+        uid = str(uuid.uuid4())
+        props = dict(props)
+        props.setdefault('timestamp', int(time.time()))
+
+        self._store_file(uid, file_path, transfer_ownership)
+        with self._db:
+            self._db.execute('INSERT INTO entries (uid) VALUES (?)', (uid,))
+            self._store_properties(uid, props)
+
+        self.Created(uid)
+        return uid
+
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature='s')
+    def Created(self, uid):
+        pass
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='sa{sv}sb', out_signature='',
+                         byte_arrays=True)
+    def update(self, uid, props, file_path, transfer_ownership):
+        self._check_uid(uid)
+
+        # As the data store, replace all of the metadata
+        self._store_file(uid, file_path, transfer_ownership)
+        with self._db:
+            self._store_properties(uid, props)
+
+        self.Updated(uid)
+
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature='s')
+    def Updated(self, uid):
+        pass
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}as', out_signature='aa{sv}u',
+                         byte_arrays=True)
+    def find(self, query, properties):
+        query = dict(query)
+        limit = query.pop('limit', -1)
+        offset = query.pop('offset', 0)
+        order_by = query.pop('order_by', ['+timestamp'])
+        if isinstance(order_by, basestring):
+            order_by = [order_by]
+
+        conditions = []
+        args = []
+        for key, value in query.items():
+            if key == 'query':
+                for word in value.split():
+                    conditions.append(
+                        'uid IN (SELECT uid FROM properties WHERE key IN '
+                        '(%s) AND value LIKE ?)' %
+                        ', '.join('?' * len(_FULLTEXT_KEYS)))
+                    args.extend(_FULLTEXT_KEYS)
+                    args.append('%%%s%%' % word.strip('*'))
+            elif isinstance(value, dict):
+                condition = 'uid IN (SELECT uid FROM properties WHERE key = ?'
+                args.append(key)
+                if 'start' in value:
+                    condition += ' AND value >= ?'
+                    args.append(_to_sql(value['start']))
+                if 'end' in value:
+                    condition += ' AND value <= ?'
+                    args.append(_to_sql(value['end']))
+                conditions.append(condition + ')')
+            else:
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                conditions.append(
+                    'uid IN (SELECT uid FROM properties WHERE key = ? AND '
+                    'value IN (%s))' % ', '.join('?' * len(value)))
+                args.append(key)
+                args.extend(_to_sql(item) for item in value)
+
+        where = ''
+        if conditions:
+            where = ' WHERE ' + ' AND '.join(conditions)
+
+        total_count = self._db.execute(
+            'SELECT COUNT(*) FROM entries' + where, args).fetchone()[0]
+
+        # As the data store, '+' sorts by decreasing value
+        order = []
+        order_args = []
+        for sort_key in order_by:
+            direction = 'DESC'
+            if sort_key.startswith('-'):
+                direction = 'ASC'
+            order.append('(SELECT value FROM properties p WHERE '
+                         'p.uid = entries.uid AND p.key = ?) %s' % direction)
+            order_args.append(sort_key.lstrip('+-'))
+
+        sql = 'SELECT uid FROM entries' + where
+        if order:
+            sql += ' ORDER BY ' + ', '.join(order)
+        sql += ' LIMIT ? OFFSET ?'
+        cursor = self._db.execute(sql, args + order_args + [limit, offset])
+
+        entries = [self._get_properties(uid, properties)
+                   for uid, in cursor.fetchall()]
+        return entries, total_count
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='s', out_signature='a{sv}')
+    def get_properties(self, uid):
+        self._check_uid(uid)
+        return self._get_properties(uid)
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='s', out_signature='s',
+                         sender_keyword='sender')
+    def get_filename(self, uid, sender=None):
+        self._check_uid(uid)
+
+        file_path = os.path.join(self._files_path, uid)
+        if not os.path.exists(file_path):
+            return ''
+
+        # As the data store, hand out a link to the file
+        destination_path = os.path.join(self._checkouts_path,
+                                        str(uuid.uuid4()))
+        try:
+            os.link(file_path, destination_path)
+        except OSError:
+            shutil.copyfile(file_path, destination_path)
+        return destination_path
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='sa{sv}', out_signature='as')
+    def get_uniquevaluesfor(self, propertyname, query=None):
+        cursor = self._db.execute(
+            'SELECT DISTINCT value FROM properties WHERE key = ?',
+            (propertyname,))
+        return [value for value, in cursor if value]
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='s', out_signature='')
+    def delete(self, uid):
+        self._check_uid(uid)
+
+        file_path = os.path.join(self._files_path, uid)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        with self._db:
+            self._db.execute('DELETE FROM entries WHERE uid = ?', (uid,))
+            self._db.execute('DELETE FROM properties WHERE uid = ?', (uid,))
+
+        self.Deleted(uid)
+
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature='s')
+    def Deleted(self, uid):
+        pass
+
+
+def start_bus():
+    """Start a private session bus and use it in this process and the
+    processes started from it.
+
+    Return: the process of the bus daemon
+
+    """
+    process = subprocess.Popen(['dbus-daemon', '--session', '--nofork',
+                                '--print-address'],
+                               stdout=subprocess.PIPE)
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = process.stdout.readline().strip()
+    return process
+
+
+def start_service(root_path, timeout=10):
+    """Run the data store service on the session bus, in another process.
+
+    Return: the process of the service
+
+    """
+    process = subprocess.Popen([sys.executable, '-m', 'sugar3.test.datastore',
+                                root_path])
+
+    bus = dbus.SessionBus()
+    end_time = time.time() + timeout
+    while not bus.name_has_owner(DS_DBUS_SERVICE):
+        if process.poll() is not None or time.time() > end_time:
+            process.kill()
+            raise RuntimeError('The data store service did not start')
+        time.sleep(0.05)
+
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a data store service.')
+    parser.add_argument('root_path', help='Directory to store the entries in')
+    args = parser.parse_args()
+
+    DBusGMainLoop(set_as_default=True)
+    data_store = DataStore(args.root_path)
+    logging.debug('Data store running in %s', args.root_path)
+    try:
+        GLib.MainLoop().run()
+    finally:
+        data_store.remove_from_connection()
+
+
+if __name__ == '__main__':
+    main()
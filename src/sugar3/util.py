@@ -21,6 +21,7 @@ UNSTABLE. We have been adding helpers randomly to this module.
 """
 
 import os
+import sys
 import time
 import hashlib
 import random
@@ -207,6 +208,65 @@ class LRU:
         return self.d.keys()
 
 
+class SizedLRU(LRU):
+    """
+    LRU queue bounded by the total size of its values instead of their
+    number. The size of each value is computed by get_size. The least
+    recently used values are evicted until the total fits in max_size,
+    but the most recent value is always kept.
+
+    Lookups are counted in hits and misses, and evicted values in
+    evictions.
+    """
+
+    def __init__(self, max_size, get_size=len):
+        LRU.__init__(self, sys.maxint)
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._get_size = get_size
+        self._sizes = {}
+
+    def __contains__(self, obj):
+        if obj in self.d:
+            return True
+        self.misses += 1
+        return False
+
+    def __getitem__(self, obj):
+        self.hits += 1
+        return LRU.__getitem__(self, obj)
+
+    def __setitem__(self, obj, val):
+        LRU.__setitem__(self, obj, val)
+        self._sizes[obj] = self._get_size(val)
+        self.size += self._sizes[obj]
+        self._evict()
+
+    def __delitem__(self, obj):
+        LRU.__delitem__(self, obj)
+        self.size -= self._sizes.pop(obj)
+
+    def _evict(self):
+        while self.size > self.max_size and self.first is not self.last:
+            del self[self.first.me[0]]
+            self.evictions += 1
+
+    def set_max_size(self, max_size):
+        self.max_size = max_size
+        self._evict()
+
+    def get_stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.d),
+                'size': self.size,
+                'max_size': self.max_size}
+
+
 units = [['%d year', '%d years', 356 * 24 * 60 * 60],
          ['%d month', '%d months', 30 * 24 * 60 * 60],
          ['%d week', '%d weeks', 7 * 24 * 60 * 60],
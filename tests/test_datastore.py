@@ -0,0 +1,154 @@
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+from sugar3.datastore import datastore
+from sugar3.test import datastore as datastore_service
+
+
+class TestDataStore(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        DBusGMainLoop(set_as_default=True)
+
+        cls._root_path = tempfile.mkdtemp()
+        cls._bus = datastore_service.start_bus()
+        cls._service = datastore_service.start_service(cls._root_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._service.terminate()
+        cls._service.wait()
+        cls._bus.terminate()
+        cls._bus.wait()
+        shutil.rmtree(cls._root_path)
+
+    def _wait(self, condition, timeout=5):
+        context = GLib.MainContext.default()
+        end_time = time.time() + timeout
+        while not condition() and time.time() < end_time:
+            context.iteration(False)
+            time.sleep(0.01)
+        return condition()
+
+    def _create(self, title, data=None):
+        ds_object = datastore.create()
+        ds_object.metadata['title'] = title
+        if data is not None:
+            file_path = os.path.join(self._root_path, 'data')
+            with open(file_path, 'w') as data_file:
+                data_file.write(data)
+            ds_object.file_path = file_path
+            datastore.write(ds_object, transfer_ownership=True)
+            # The data store has taken the file
+            ds_object.file_path = None
+        else:
+            datastore.write(ds_object)
+        return ds_object
+
+    def test_write_get(self):
+        ds_object = self._create('write get', 'some data')
+        self.assertIsNotNone(ds_object.object_id)
+
+        entry = datastore.get(ds_object.object_id)
+        self.assertEqual(entry.metadata['title'], 'write get')
+        with entry.open_file() as data_file:
+            self.assertEqual(data_file.read(), 'some data')
+
+        ds_object.metadata['title'] = 'written again'
+        datastore.write(ds_object)
+        entry = datastore.get(ds_object.object_id)
+        self.assertEqual(entry.metadata['title'], 'written again')
+
+    def test_find(self):
+        ds_objects = [self._create('find %d' % i) for i in range(3)]
+        object_ids = [ds_object.object_id for ds_object in ds_objects]
+
+        entries, total_count = datastore.find({'uid': object_ids},
+                                              properties=['uid'])
+        self.assertEqual(total_count, 3)
+        self.assertEqual(set(entry.object_id for entry in entries),
+                         set(object_ids))
+
+        # The title was not requested, it is loaded lazily
+        titles = set(entry.metadata['title'] for entry in entries)
+        self.assertEqual(titles, set(['find 0', 'find 1', 'find 2']))
+
+    def test_delete(self):
+        ds_object = self._create('delete')
+        datastore.delete(ds_object.object_id)
+
+        entries, total_count = datastore.find({'uid': ds_object.object_id})
+        self.assertEqual(total_count, 0)
+
+    def test_copy_many(self):
+        ds_objects = [self._create('copy %d' % i, 'data %d' % i)
+                      for i in range(3)]
+        ds_objects.append(datastore.DSObject('no-such-entry'))
+
+        progress = []
+        failed = datastore.copy_many(
+            ds_objects, '/media/usb',
+            progress_cb=lambda *args: progress.append(args))
+
+        self.assertEqual([ds_object for ds_object, error in failed],
+                         ds_objects[3:])
+        self.assertEqual([(done, total) for done, total, speed in progress],
+                         [(1, 4), (2, 4), (3, 4), (4, 4)])
+
+        entries, total_count = datastore.find({'mountpoint': '/media/usb'})
+        self.assertEqual(total_count, 3)
+
+    def test_get_unique_values(self):
+        ds_object = datastore.create()
+        ds_object.metadata['title'] = 'unique values'
+        ds_object.metadata['mime_type'] = 'text/x-unique'
+        ds_object.metadata['tags'] = 'one, two'
+        datastore.write(ds_object)
+
+        # Cached values are updated once the data store has announced the
+        # new entry
+        self.assertTrue(self._wait(
+            lambda: 'text/x-unique' in
+            datastore.get_unique_values('mime_type')))
+        tags = datastore.get_unique_values('tags')
+        self.assertIn('one', tags)
+        self.assertIn('two', tags)
+
+    def test_get_unique_values_updated(self):
+        ds_object = datastore.create()
+        ds_object.metadata['title'] = 'unique values updated'
+        ds_object.metadata['mime_type'] = 'text/x-before'
+        datastore.write(ds_object)
+        self.assertTrue(self._wait(
+            lambda: 'text/x-before' in
+            datastore.get_unique_values('mime_type')))
+
+        ds_object.metadata['mime_type'] = 'text/x-after'
+        datastore.write(ds_object)
+        self.assertTrue(self._wait(
+            lambda: 'text/x-after' in
+            datastore.get_unique_values('mime_type')))
+        self.assertNotIn('text/x-before',
+                         datastore.get_unique_values('mime_type'))
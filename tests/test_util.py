@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+
+# Copyright (C) 2026, Sugar Labs
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import unittest
+
+from sugar3.util import SizedLRU
+
+
+class TestSizedLRU(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = SizedLRU(10)
+        cache['a'] = 'aaaa'
+        cache['b'] = 'bbbb'
+        self.assertEqual(cache['a'], 'aaaa')
+
+        cache['c'] = 'cccc'
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertIn('c', cache)
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_keeps_most_recent_value(self):
+        cache = SizedLRU(2)
+        cache['a'] = 'aaaa'
+        self.assertIn('a', cache)
+        self.assertEqual(cache.size, 4)
+
+    def test_replace_value(self):
+        cache = SizedLRU(10)
+        cache['a'] = 'aaaa'
+        cache['a'] = 'aa'
+        self.assertEqual(cache.size, 2)
+
+    def test_stats(self):
+        cache = SizedLRU(10)
+        cache['a'] = 'aaaa'
+        if 'a' in cache:
+            cache['a']
+        self.assertNotIn('b', cache)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['size'], 4)
+
+    def test_set_max_size(self):
+        cache = SizedLRU(10)
+        cache['a'] = 'aaaa'
+        cache['b'] = 'bbbb'
+        cache.set_max_size(4)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 4)